@@ -0,0 +1,130 @@
+from collections import OrderedDict
+from kivy.logger import Logger
+from kivy.graphics.texture import Texture
+
+APP = "KBAtlas"
+
+default_page_size = 2048
+default_slot_size = 256
+default_max_pages = 4
+
+
+class Slot(object):
+    __slots__ = ('page', 'pos', 'key', 'region', 'users')
+
+    def __init__(self, page, pos):
+        self.page = page
+        self.pos = pos
+        self.key = None
+        self.region = None
+        self.users = 0
+
+
+class ThumbAtlas(object):
+    '''Packs the decoded thumbnails into a few large shared textures
+
+    Every page texture is divided in square slots of slot_size, each holding
+    one thumbnail, and widgets draw the region of its slot. Slots are
+    reference counted: the ones no widget uses anymore keep their thumbnail,
+    in case it is shown again, until the slot is needed for another one,
+    least recently used first. Images bigger than a slot, or added when all
+    the slots of max_pages are in use, are not packed and add returns None.
+
+    Pages have the color format of the images packed in them, since GLES
+    can't upload an rgb image into an rgba texture, so jpegs and images
+    with alpha go to different pages.
+    '''
+
+    def __init__(self, page_size=default_page_size,
+                 slot_size=default_slot_size, max_pages=default_max_pages):
+        self.page_size = page_size
+        self.slot_size = slot_size
+        self.max_pages = max_pages
+        self.pages = []
+        self.slots = {}  # key -> Slot
+        self.free = {}  # colorfmt -> slots never used
+        self.unused = OrderedDict()  # key -> Slot without users, LRU first
+        self.hits = self.misses = 0
+
+    def _new_page(self, fmt):
+        texture = Texture.create(size=(self.page_size, self.page_size),
+                                 colorfmt=fmt)
+        self.pages.append(texture)
+        n = self.page_size // self.slot_size
+        ss = self.slot_size
+        self.free.setdefault(fmt, []).extend(
+            Slot(texture, (x * ss, y * ss))
+            for y in reversed(range(n)) for x in reversed(range(n)))
+        Logger.info("%s: Created %s page %d" % (APP, fmt, len(self.pages)))
+
+    def _slot(self, fmt):
+        free = self.free.get(fmt)
+        if not free and len(self.pages) < self.max_pages:
+            self._new_page(fmt)
+            free = self.free[fmt]
+        if free:
+            return free.pop()
+        for key, slot in self.unused.iteritems():
+            if slot.page.colorfmt == fmt:
+                del self.unused[key]
+                del self.slots[key]
+                return slot
+        return None
+
+    def get(self, key):
+        '''Return the texture region of key, or None if not packed'''
+        slot = self.slots.get(key)
+        if slot is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if not slot.users:
+            del self.unused[key]
+        slot.users += 1
+        return slot.region
+
+    def add(self, key, imdata):
+        '''Pack the ImageData imdata, return its texture region'''
+        if key in self.slots:
+            return self.get(key)
+        w, h = imdata.width, imdata.height
+        if w > self.slot_size or h > self.slot_size:
+            return None
+        slot = self._slot(imdata.fmt)
+        if slot is None:
+            Logger.debug("%s: Full, not packing %s" % (APP, key))
+            return None
+        x, y = slot.pos
+        slot.page.blit_buffer(imdata.data, pos=(x, y), size=(w, h),
+                              colorfmt=imdata.fmt)
+        region = slot.page.get_region(x, y, w, h)
+        if imdata.flip_vertical:
+            # Rows were uploaded top first
+            region.flip_vertical()
+        slot.key, slot.region, slot.users = key, region, 1
+        self.slots[key] = slot
+        return region
+
+    def release(self, key):
+        '''Let the slot of key be reused once no widget shows it'''
+        slot = self.slots.get(key)
+        if slot is None or not slot.users:
+            return
+        slot.users -= 1
+        if not slot.users:
+            self.unused[key] = slot
+
+    def clear(self):
+        '''Forget the thumbnails no widget uses'''
+        for key, slot in self.unused.items():
+            del self.slots[key]
+            slot.key = slot.region = None
+            self.free.setdefault(slot.page.colorfmt, []).append(slot)
+        self.unused.clear()
+
+    def stats(self):
+        return {'pages': len(self.pages), 'used': len(self.slots),
+                'unused': len(self.unused), 'hits': self.hits,
+                'misses': self.misses}
+
+atlas = ThumbAtlas()
@@ -0,0 +1,80 @@
+from urllib import urlencode
+from posixpath import join as urljoin
+
+
+def pack_item(name, data):
+    '''One item of a batch response, data None if name was not found'''
+    if data is None:
+        return "404 0 %s\n" % name
+    return "200 %d %s\n%s" % (len(data), name, data)
+
+
+def thumb_batch(url):
+    '''Return the (batch url, name) a thumbnail url can be fetched with,
+    or None for other urls. Thumbnails of <server>/thumb/<dir>/<name> are
+    served together by <server>/thumbs/<dir>/?n=<name>&n=...'''
+    base, sep, name = url.rpartition('/')
+    root, sep, path = (base + '/').partition('/thumb/')
+    if not sep or '?' in name or not name:
+        return None
+    return urljoin(root, 'thumbs', path, ''), name
+
+
+def batch_url(url, names):
+    return url + '?' + urlencode([('n', name) for name in names])
+
+
+class PackParser(object):
+    '''Incremental parser of batch responses, for HttpRequest
+
+    The response is a sequence of items, each one a "<status> <length>
+    <name>" line followed by length bytes of data. Every item is written to
+    the file given for its name in files as it arrives, and returned as a
+    (name, ok) tuple. Names missing from the response are returned as
+    failed by close().
+    '''
+
+    def __init__(self, files):
+        self.files = files  # name -> file path
+        self.missing = set(files)
+        self._buf = ""
+        self._item = None  # (status, length, name) being received
+
+    def feed(self, data):
+        self._buf += data
+        done = []
+        while True:
+            if self._item is None:
+                end = self._buf.find("\n")
+                if end < 0:
+                    break
+                header, self._buf = self._buf[:end], self._buf[end + 1:]
+                try:
+                    status, length, name = header.split(" ", 2)
+                    self._item = (int(status), int(length), name)
+                except ValueError:
+                    continue
+            status, length, name = self._item
+            if len(self._buf) < length:
+                break
+            data, self._buf = self._buf[:length], self._buf[length:]
+            self._item = None
+            done.append(self._write(status, name, data))
+        return [d for d in done if d]
+
+    def _write(self, status, name, data):
+        if name not in self.missing:
+            return None
+        self.missing.discard(name)
+        ok = status == 200
+        if ok:
+            try:
+                with open(self.files[name], 'wb') as f:
+                    f.write(data)
+            except IOError:
+                ok = False
+        return name, ok
+
+    def close(self):
+        missing, self.missing = self.missing, set()
+        return [(name, False) for name in missing]
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Benchmarks of the listing and image pipelines against fakeserver.py
+
+Serves an in-memory gallery with a directory of every size given, all
+with the same sample image, with the latency and bandwidth given, and
+measures, in ms unless noted:
+
+    parse_<n>          get_direntries of a listing of n entries
+    parse_stream_<n>   ListingParser fed the listing in 16 KB chunks
+    rescache_<n>       ResCache.set of the listing, then indexing the log
+                       again and reading it back
+    got_dirlist_<n>    ImageDir.got_dirlist of the cached listing
+    listing_<n>        opening the directory until the grid has every item
+    first_paint_<n>    opening the directory until a thumbnail is shown
+    full_paint_<n>     opening the directory until the visible rows are
+    rss_<n>            peak resident memory after it, in MB
+    carousel_open      opening the carousel until its image is shown
+    swipe, swipe_max   median and worst swipe until the next image is shown
+
+The parse and cache benchmarks run without a window. The others run the
+widgets in a hidden Kivy window, in a temporary cache dir, and need PIL or
+a --sample image. Results can be saved as a baseline, and compared with
+one: measures more than --tolerance worse than the baseline are reported
+as regressions, and make the exit status 1.
+
+Usage: bench.py [--sizes 100,1000,10000,100000] [--latency ms]
+                [--bandwidth KB/s] [--save file] [--compare file] ...
+'''
+import os
+import sys
+os.environ.setdefault('KIVY_NO_ARGS', '1')  # The options are ours
+
+import resource
+from argparse import ArgumentParser
+from json import loads, dumps
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from fakeserver import Gallery, FakeServer, PILImage, sample_jpeg, DIR
+from listing import ListingParser, get_direntries, dump_listing
+from rescache import ResCache
+
+chunk_size = 16 * 1024
+timeout = 120  # Seconds to wait for each step of the window benchmarks
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    return (values[(n - 1) // 2] + values[n // 2]) / 2.
+
+
+def timed(func, runs):
+    '''Median ms of runs calls to func'''
+    times = []
+    for i in range(runs):
+        start = time()
+        func()
+        times.append((time() - start) * 1000)
+    return median(times)
+
+
+def dir_name(n):
+    return "d%d" % n
+
+
+def make_listing(n):
+    return dump_listing(dir_name(n), "v1", [
+        ["img%06d.jpg" % i, 1, 'file'] for i in range(n)])
+
+
+def bench_parse(sizes, runs):
+    results = {}
+    for n in sizes:
+        res = make_listing(n)
+
+        def stream():
+            parser = ListingParser()
+            for i in xrange(0, len(res), chunk_size):
+                parser.feed(res[i:i + chunk_size])
+            parser.close()
+
+        results['parse_%d' % n] = timed(lambda: get_direntries(res), runs)
+        results['parse_stream_%d' % n] = timed(stream, runs)
+    return results
+
+
+def bench_rescache(sizes, runs):
+    results = {}
+    for n in sizes:
+        res = make_listing(n)
+        url = "http://bench/%s/" % dir_name(n)
+
+        def set_get():
+            root = mkdtemp()
+            try:
+                cache = ResCache(root)
+                cache.set(url, res)
+                cache.worker.queue.join()
+                assert ResCache(root).get(url) == res
+            finally:
+                rmtree(root)
+
+        results['rescache_%d' % n] = timed(set_get, runs)
+    return results
+
+
+def bench_window(url, sizes, swipes):
+    '''Run the widget benchmarks in a hidden window, return their results'''
+    from kivy.config import Config
+    Config.set('graphics', 'window_state', 'hidden')
+    Config.set('input', 'mouse', 'mouse,disable_multitouch')
+    from kivy.app import App
+    from kivy.clock import Clock
+    from kivy.uix.floatlayout import FloatLayout
+    from download import VISIBLE
+    from image import set_cache_dir
+    from imagedir import ImageDir, rescache
+
+    def shown(image, texture):
+        '''True once the cached image shows its source, not a placeholder'''
+        ticket = image.ticket
+        return (texture is not None and image.decode_job is None and
+                not image.deferred and (ticket is None or ticket.cancelled))
+
+    class BenchApp(App):
+
+        def build(self):
+            self.results = {}
+            return FloatLayout()
+
+        def get_application_config(self):
+            return os.path.join(os.getcwd(), "bench.ini")
+
+        def on_start(self):
+            self.steps = self.run_steps()
+            self.waiting = None
+            self.advance(None)
+            Clock.schedule_interval(self.poll, 0)
+
+        def poll(self, dt):
+            check, deadline = self.waiting
+            if check():
+                self.advance(True)
+            elif time() > deadline:
+                self.advance(False)
+
+        def advance(self, ok):
+            '''Run the steps until the next condition to wait for'''
+            try:
+                check = self.steps.send(ok)
+            except StopIteration:
+                self.stop()
+                return
+            self.waiting = (check, time() + timeout)
+
+        def wait(self, name, start, ok):
+            if ok:
+                self.results[name] = (time() - start) * 1000
+            else:
+                print "Timed out waiting for %s" % name
+
+        def run_steps(self):
+            results = self.results
+            imagedir = ImageDir(server_url=url)
+            self.root.add_widget(imagedir)
+            yield lambda: imagedir.content is not None
+            for n in sizes:
+                path = dir_name(n)
+                start = time()
+                imagedir.fetch_dir(path)
+
+                def visible():
+                    content = imagedir.content
+                    if content is None or content.path != path:
+                        return []
+                    return [c for c in content.cells.values()
+                            if c.priority == VISIBLE]
+
+                ok = yield lambda: (visible() and
+                                    len(imagedir.content.items) == n)
+                self.wait('listing_%d' % n, start, ok)
+                ok = yield lambda: any(shown(c, c.texture) for c in visible())
+                self.wait('first_paint_%d' % n, start, ok)
+                ok = yield lambda: all(shown(c, c.texture) for c in visible())
+                self.wait('full_paint_%d' % n, start, ok)
+                results['rss_%d' % n] = resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+                res = rescache.get(url + path + '/')
+                imagedir._items = {}
+                start = time()
+                imagedir.got_dirlist(None, res)
+                results['got_dirlist_%d' % n] = (time() - start) * 1000
+
+            from carousel import ImageCarousel
+            self.root.remove_widget(imagedir)
+            path = dir_name(sizes[0])
+            start = time()
+            carousel = ImageCarousel(server_url=url, path=path,
+                                     filename="img000000.jpg")
+            carousel.anim_move_duration = 0.01
+            self.root.add_widget(carousel)
+
+            def current(i):
+                slide = carousel.current_slide
+                return (slide is not None and
+                        carousel.first + carousel.index == i and
+                        shown(slide, slide.image.texture))
+
+            ok = yield lambda: current(0)
+            self.wait('carousel_open', start, ok)
+            times = []
+            for i in range(1, min(swipes, sizes[0] - 1) + 1):
+                start = time()
+                carousel.load_next()
+                ok = yield lambda: current(i)
+                if not ok:
+                    print "Timed out waiting for swipe %d" % i
+                    break
+                times.append((time() - start) * 1000)
+            if times:
+                results['swipe'] = median(times)
+                results['swipe_max'] = max(times)
+
+    cwd = os.getcwd()
+    tmp = mkdtemp()
+    os.chdir(tmp)  # The response cache lives in the working dir
+    try:
+        set_cache_dir(os.path.join(tmp, ".kbimgcache"))
+        app = BenchApp()
+        app.run()
+        return app.results
+    finally:
+        os.chdir(cwd)
+        rmtree(tmp, ignore_errors=True)
+
+
+def compare(results, baseline, tolerance):
+    '''Print results next to baseline, return the regressed names. Every
+    measure is better lower'''
+    regressions = []
+    print "%-22s %12s %12s %8s" % ('', 'baseline', 'current', 'change')
+    for name in sorted(set(results) | set(baseline)):
+        base, value = baseline.get(name), results.get(name)
+        if base is None or value is None:
+            print "%-22s %12s %12s" % (name, "-" if base is None else
+                                       "%.2f" % base,
+                                       "-" if value is None else
+                                       "%.2f" % value)
+            continue
+        change = (value - base) / base if base else 0
+        flag = ""
+        if change > tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print "%-22s %12.2f %12.2f %+7.1f%%%s" % (
+            name, base, value, change * 100, flag)
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default="100,1000,10000,100000",
+                        help="entries of the directories, comma separated")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="ms added to every request")
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help="KB/s per connection, 0 for unlimited")
+    parser.add_argument('--runs', type=int, default=5,
+                        help="runs of the parse and cache benchmarks")
+    parser.add_argument('--swipes', type=int, default=10)
+    parser.add_argument('--sample', help="image served for every file")
+    parser.add_argument('--no-window', action='store_true',
+                        help="only run the parse and cache benchmarks")
+    parser.add_argument('--save', help="write the results as a baseline")
+    parser.add_argument('--compare', help="baseline to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="change over the baseline that is a regression")
+    args = parser.parse_args()
+    sizes = sorted(int(n) for n in args.sizes.split(','))
+
+    results = bench_parse(sizes, args.runs)
+    results.update(bench_rescache(sizes, args.runs))
+
+    if not args.no_window:
+        if args.sample:
+            with open(args.sample, 'rb') as f:
+                sample = f.read()
+        elif PILImage is not None:
+            sample = sample_jpeg()
+        else:
+            sys.exit("The window benchmarks need PIL or --sample")
+        gallery = Gallery()
+        gallery.put_dir('', [[dir_name(n), 1, DIR] for n in sizes])
+        for n in sizes:
+            gallery.fill(dir_name(n), n, sample)
+        server = FakeServer(gallery, latency=args.latency / 1000.,
+                            bandwidth=args.bandwidth * 1024 or None).start()
+        results.update(bench_window(server.url, sizes, args.swipes))
+        server.stop()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            f.write(dumps(results, indent=1, sort_keys=True))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = loads(f.read())
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+    else:
+        for name in sorted(results):
+            print "%-22s %12.2f" % (name, results[name])
+
+if __name__ == '__main__':
+    main()
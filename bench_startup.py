@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Cold start benchmark
+
+Runs the app several times with KBGALLERY_BENCH_STARTUP set, so that it
+exits once it shows the top level directory, and prints the median
+duration of each startup phase as marked in startup.py:
+
+    import       python and module imports, up to the App class
+    build        kv file and config, up to App.build
+    on_start     settings applied and widgets created, up to App.on_start
+    first frame  until the first frame is drawn
+    directory    until the top level directory is shown, from the response
+                 cache if it has it, else from the server
+
+Usage: bench_startup.py [runs]
+'''
+import sys
+from os import environ
+from os.path import dirname, abspath
+from json import loads
+from time import time
+from subprocess import Popen, PIPE
+
+
+def run():
+    '''Start the app once, return ({phase: ms}, process wall time in ms)'''
+    env = dict(environ, KBGALLERY_BENCH_STARTUP='1')
+    start = time()
+    p = Popen([sys.executable, 'main.py'], cwd=dirname(abspath(__file__)),
+              env=env, stdout=PIPE)
+    out = p.communicate()[0]
+    wall = (time() - start) * 1000
+    for line in out.splitlines():
+        if line.startswith("KBSTARTUP "):
+            return loads(line[len("KBSTARTUP "):]), wall
+    raise RuntimeError("No startup timings, the app exited with %s"
+                       % p.returncode)
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    return (values[(n - 1) // 2] + values[n // 2]) / 2.
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    phases = []  # In order of the first run
+    times = {}  # phase -> [ms]
+    walls = []
+    for i in range(runs):
+        marks, wall = run()
+        for phase, ms in marks:
+            if phase not in times:
+                phases.append(phase)
+            times.setdefault(phase, []).append(ms)
+        walls.append(wall)
+    print "Median of %d runs" % runs
+    for phase in phases:
+        print "%-12s %8.1f ms" % (phase, median(times[phase]))
+    print "%-12s %8.1f ms" % ('total', sum(median(times[p]) for p in phases))
+    print "%-12s %8.1f ms" % ('process', median(walls))
@@ -32,7 +32,7 @@ source.include_exts = py,png,jpg,kv,atlas,json
 version = 0.0.1
 
 # (list) Application requirements
-requirements = kivy
+requirements = kivy,pil
 
 # (list) Garden requirements
 #garden_requirements =
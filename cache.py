@@ -0,0 +1,371 @@
+import errno
+from os import listdir, makedirs, rename, unlink
+from json import loads, dumps
+from time import time
+from hashlib import sha1
+from shutil import rmtree
+from os.path import dirname, join, isdir
+from threading import Thread
+from Queue import Queue
+from collections import OrderedDict
+from kivy.logger import Logger
+from kivy.clock import Clock
+
+APP = "KBCache"
+
+THUMB = 'thumb'
+FULL = 'full'
+
+MB = 1024 * 1024
+default_budgets = {THUMB: 64 * MB, FULL: 256 * MB}
+
+# Number of entries dropped from the index per eviction step, so that a big
+# budget reduction doesn't block a frame
+evict_batch = 50
+
+# Seconds between index writes. Changes in between are written in one batch
+save_delay = 5
+
+INDEX = "index.log"
+
+
+class FileWorker(Thread):
+    '''Runs filesystem operations out of the UI thread, in order'''
+
+    def __init__(self):
+        super(FileWorker, self).__init__()
+        self.daemon = True
+        self.queue = Queue()
+
+    def run(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                func(*args)
+            except Exception as e:
+                if getattr(e, 'errno', None) != errno.ENOENT:
+                    Logger.warning("%s: %s%s failed: %s" % (
+                        APP, func.__name__, args[:1], e))
+            self.queue.task_done()
+
+    def put(self, func, *args):
+        if not self.is_alive():
+            self.start()
+        self.queue.put((func, args))
+
+    def remove(self, path):
+        self.put(_remove, path)
+
+
+def _remove(path):
+    if isdir(path):
+        rmtree(path)
+    else:
+        unlink(path)
+
+
+def make_parent_dir(filename):
+    '''Create the directory filename goes in, if it doesn't exist'''
+    try:
+        makedirs(dirname(filename))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _append(filename, data):
+    make_parent_dir(filename)
+    with open(filename, "a") as f:
+        f.write(data)
+
+
+def _replace(filename, data):
+    make_parent_dir(filename)
+    with open(filename + ".tmp", "w") as f:
+        f.write(data)
+    rename(filename + ".tmp", filename)
+
+
+class CacheEntry(object):
+    __slots__ = ('url', 'size', 'etag', 'mtime', 'atime', 'pinned')
+
+    def __init__(self, url, size, etag=None, mtime=None, atime=None,
+                 pinned=None):
+        self.url = url
+        self.size = size
+        self.etag = etag
+        self.mtime = mtime
+        self.atime = atime or time()
+        # Offline albums keeping the file. Older indexes have a single one
+        if isinstance(pinned, basestring):
+            pinned = [pinned]
+        self.pinned = set(pinned or ())
+
+
+class DiskCache(object):
+    '''Size bounded LRU cache of downloaded images
+
+    Every kind of image (thumbnails, full size images) lives in its own
+    subdirectory and has its own byte budget. Files are named after the sha1
+    of their url. The index of cached urls is read once from an append only
+    log, lives in memory so lookups don't touch the filesystem, and its
+    changes are appended to the log in batches.
+
+    Entries pinned by offline albums are never evicted, and don't count in
+    the budget of their kind, until all the albums unpin them.
+    '''
+
+    def __init__(self, root, budgets=default_budgets):
+        self.root = root
+        self.budgets = dict(budgets)
+        self.worker = FileWorker()
+        self.hits = self.misses = 0
+        self._trigger_evict = Clock.create_trigger(self._evict_step)
+        self._trigger_save = Clock.create_trigger(self.save, save_delay)
+        self._reset()
+
+    def _reset(self):
+        self.loaded = False
+        self.entries = dict((kind, OrderedDict()) for kind in self.budgets)
+        self.usage = dict((kind, 0) for kind in self.budgets)
+        self.pinned_usage = dict((kind, 0) for kind in self.budgets)
+        self._dirty = OrderedDict()
+        self._lines = 0  # Records in the index log
+
+    def set_root(self, root):
+        self.root = root
+        self._reset()
+
+    def set_budget(self, kind, budget):
+        self.budgets[kind] = budget
+        self._trigger_evict()
+
+    def key(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return sha1(url).hexdigest()
+
+    def filename(self, kind, key):
+        return join(self.root, kind, key[:2], key + ".jpg")
+
+    def path(self, kind, url):
+        return self.filename(kind, self.key(url))
+
+    def load(self):
+        '''Read the index log. Called once, on the first lookup'''
+        self._reset()
+        index = join(self.root, INDEX)
+        records = {}
+        lines = 0
+        try:
+            with open(index) as f:
+                for l in f:
+                    lines += 1
+                    try:
+                        r = loads(l)
+                    except ValueError:
+                        continue  # Truncated by a crash while appending
+                    records[(r[0], r[1])] = r
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Files without index entries can't be mapped back to their urls
+            try:
+                names = listdir(self.root)
+            except OSError:
+                names = []
+            for name in names:
+                if name in self.budgets or len(name) == 2:
+                    self._remove_dir(join(self.root, name))
+
+        found = [(r[0], r[1], CacheEntry(*r[2:]))
+                 for r in records.values() if len(r) > 2]
+        # Least recently used first
+        found.sort(key=lambda f: f[2].atime)
+        for kind, key, entry in found:
+            if kind not in self.entries:
+                continue
+            self.entries[kind][key] = entry
+            self._usage(kind, entry)[kind] += entry.size
+        self.loaded = True
+        self._lines = lines
+
+        if self._compactable():
+            self._rewrite()
+
+        Logger.info("%s: Loaded %s" % (APP, ", ".join(
+            "%s %d files %d bytes" % (k, len(self.entries[k]), self.usage[k])
+            for k in self.budgets)))
+        self._trigger_evict()
+
+    def _remove_dir(self, path):
+        # Move it out of the way first, so new downloads are not removed
+        trash = "%s.%d.old" % (path, time() * 1000)
+        try:
+            rename(path, trash)
+        except OSError:
+            return
+        self.worker.remove(trash)
+
+    def _record(self, kind, key, entry):
+        if entry is None:
+            return dumps([kind, key]) + "\n"
+        record = [kind, key, entry.url, entry.size, entry.etag, entry.mtime,
+                  entry.atime]
+        if entry.pinned:
+            record.append(sorted(entry.pinned))
+        return dumps(record) + "\n"
+
+    def _usage(self, kind, entry):
+        return self.pinned_usage if entry.pinned else self.usage
+
+    def _changed(self, kind, key, entry):
+        self._dirty.pop((kind, key), None)
+        self._dirty[(kind, key)] = entry
+        self._trigger_save()
+
+    def save(self, *args):
+        if not self._dirty:
+            return
+        self._lines += len(self._dirty)
+        if self._compactable():
+            # Mostly superseded records, mainly access times of lookups
+            self._dirty = OrderedDict()
+            self._rewrite()
+            return
+        data = "".join(self._record(kind, key, entry)
+                       for (kind, key), entry in self._dirty.items())
+        self._dirty = OrderedDict()
+        self.worker.put(_append, join(self.root, INDEX), data)
+
+    def _compactable(self):
+        count = sum(len(entries) for entries in self.entries.values())
+        return self._lines > 2 * count + 100
+
+    def _rewrite(self):
+        '''Replace the index log with a record per entry'''
+        records = [self._record(kind, key, entry)
+                   for kind, entries in self.entries.items()
+                   for key, entry in entries.items()]
+        self._lines = len(records)
+        self.worker.put(_replace, join(self.root, INDEX), "".join(records))
+
+    def sync(self):
+        '''Write the pending changes and wait until they are on disk'''
+        self.save()
+        if self.worker.is_alive():
+            self.worker.queue.join()
+
+    def get(self, kind, url):
+        '''Return the CacheEntry of url, without marking it as used'''
+        if not self.loaded:
+            self.load()
+        return self.entries[kind].get(self.key(url))
+
+    def lookup(self, kind, url):
+        '''Return the cached file for url, or None if it is not cached'''
+        if not self.loaded:
+            self.load()
+        entries = self.entries[kind]
+        key = self.key(url)
+        try:
+            entry = entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entries[key] = entry  # Most recently used
+        entry.atime = time()
+        self._changed(kind, key, entry)
+        return self.filename(kind, key)
+
+    def add(self, kind, url, size, etag=None, mtime=None, pinned=None):
+        if not self.loaded:
+            self.load()
+        entries = self.entries[kind]
+        key = self.key(url)
+        old = entries.pop(key, None)
+        albums = set([pinned]) if pinned else set()
+        if old:
+            self._usage(kind, old)[kind] -= old.size
+            albums |= old.pinned
+        entries[key] = entry = CacheEntry(url, size, etag, mtime,
+                                          pinned=albums)
+        self._usage(kind, entry)[kind] += size
+        self._changed(kind, key, entry)
+        if self.usage[kind] > self.budgets[kind]:
+            self._trigger_evict()
+
+    def discard(self, kind, url):
+        key = self.key(url)
+        entry = self.entries[kind].pop(key, None)
+        if entry is not None:
+            self._usage(kind, entry)[kind] -= entry.size
+            self._changed(kind, key, None)
+
+    def pin(self, kind, url, album):
+        '''Keep the cached url for album. Return False if not cached'''
+        entry = self.get(kind, url)
+        if entry is None:
+            return False
+        if album not in entry.pinned:
+            self._usage(kind, entry)[kind] -= entry.size
+            entry.pinned.add(album)
+            self.pinned_usage[kind] += entry.size
+            self._changed(kind, self.key(url), entry)
+        return True
+
+    def unpin(self, album):
+        '''Let the entries pinned by album be evicted again, unless other
+        albums pin them too'''
+        if not self.loaded:
+            self.load()
+        for kind, entries in self.entries.items():
+            for key, entry in entries.items():
+                if album not in entry.pinned:
+                    continue
+                entry.pinned.discard(album)
+                if not entry.pinned:
+                    self.pinned_usage[kind] -= entry.size
+                    self.usage[kind] += entry.size
+                self._changed(kind, key, entry)
+        self._trigger_evict()
+
+    def _evict_step(self, dt):
+        pending = False
+        for kind, entries in self.entries.items():
+            count = 0
+            while self.usage[kind] > self.budgets[kind] and entries:
+                if count == evict_batch:
+                    pending = True
+                    break
+                key, entry = entries.popitem(last=False)
+                count += 1
+                if entry.pinned:
+                    entries[key] = entry  # Skipped, to the end of the queue
+                    continue
+                self.usage[kind] -= entry.size
+                self._changed(kind, key, None)
+                self.worker.remove(self.filename(kind, key))
+            if count:
+                Logger.debug("%s: Evicted %d %s files, %d bytes used" % (
+                    APP, count, kind, self.usage[kind]))
+        if pending:
+            self._trigger_evict()
+
+    def clear(self):
+        try:
+            rmtree(self.root)
+            Logger.info("%s: Cleared cache dir %s" % (APP, self.root))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._reset()
+        self.loaded = True
+
+    def stats(self):
+        stats = {'hits': self.hits, 'misses': self.misses}
+        for kind in self.budgets:
+            stats[kind] = self.usage[kind]
+            stats[kind + '_pinned'] = self.pinned_usage[kind]
+        return stats
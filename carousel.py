@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+from urllib import quote
+from posixpath import join as urljoin
+from functools import partial
+
+from kivy import platform
+from kivy.clock import Clock
+from kivy.logger import Logger
+from kivy.properties import StringProperty
+from kivy.core.window import Window
+from kivy.uix.carousel import Carousel
+
+from cache import FULL
+from download import VISIBLE, NEIGHBOUR
+from httppool import HttpRequest
+from image import CachedImage
+from imagedir import rescache, screen_query, FILE
+from listing import ListingParser, get_direntries
+from listing import conditional_request, update_listing
+from prefetch import carousel_prefetcher
+
+APP = 'KBCarousel'
+
+slide_window = 2  # Slides kept each side of the current one
+
+
+class ImageCarousel(Carousel):
+    '''Carousel of the images of a directory
+
+    Only a window of slide_window slides each side of the current one have
+    a widget. As the index moves the slides leaving the window are rebound
+    to the files entering it on the other side, releasing their textures.
+    '''
+
+    server_url = StringProperty("")
+    path = StringProperty("")
+    filename = StringProperty("")   # To indicate which image to show first
+
+    def __init__(self, **kwargs):
+        self.files = []  # Dicts of the CachedImage properties of each file
+        self.req = None  # Listing request
+        self.first = 0  # Index in files of the first slide
+        super(ImageCarousel, self).__init__(**kwargs)
+        self._trigger_recenter = Clock.create_trigger(self.recenter)
+        if platform in ('linux', 'windows'):
+            self._keyboard = Window.request_keyboard(
+                self._keyboard_closed, self, 'text')
+            self._keyboard.bind(on_key_down=self._on_keyboard_down)
+
+    def _keyboard_closed(self):
+        self._keyboard.unbind(on_key_down=self._on_keyboard_down)
+        self._keyboard = None
+
+    def _on_keyboard_down(self, keyboard, keycode, text, modifiers):
+        if keycode[1] == 'escape':
+            keyboard.release()
+        elif keycode[1] == 'left':
+            self.load_previous()
+        elif keycode[1] == 'right':
+            self.load_next()
+
+        # Return True to accept the key. Otherwise, it will be used by
+        # the system.
+        return False
+
+    def on_path(self, widget, path):
+        if not self.server_url:
+            return
+        self.clear_slides()
+        url = urljoin(self.server_url, quote((path).encode('utf-8')), "")
+        res = rescache.get(url)
+        self.request_listing(url, res)
+        if res:
+            # Create the widget content from the cache data, but since this is
+            # called from the parent's init, wait until this object is fully
+            # initialized
+            callback = partial(self.got_dir, None, res)
+            Clock.schedule_once(callback, 0)
+
+    def on_server_url(self, widget, server_url):
+        self.on_path(None, self.path)
+
+    def request_listing(self, url, cached=None):
+        '''Fetch the listing of url, only its changes since cached if
+        given'''
+        req_url, headers = conditional_request(url, cached)
+        self.cancel_request()
+        self.req = req = HttpRequest(req_url, on_success=self.got_dir,
+                                     req_headers=headers,
+                                     parser=ListingParser())
+        req.cache_url = url
+
+    def cancel_request(self):
+        if self.req:
+            self.req.cancel()
+            self.req = None
+
+    def clear_slides(self):
+        '''Stop the loading of the slides and remove them'''
+        for image in self.slides:
+            image.release()
+        self.clear_widgets()
+
+    def got_dir(self, req, res, dt=0):
+        if req:
+            self.req = None
+            try:
+                update = update_listing(rescache.get(req.cache_url), req, res)
+            except ValueError as e:
+                Logger.warning("%s: %s, fetching full listing" % (APP, e))
+                self.request_listing(req.cache_url)
+                return
+            if not update:
+                return
+            self.clear_slides()
+            res, sdir, direntries = update
+            rescache.set(req.cache_url, res)
+        else:
+            sdir, direntries = get_direntries(res)
+
+        files = [de for de in direntries if de[2] == FILE]
+
+        jurl = self.server_url + urljoin('jpeg',
+                                         quote(sdir.encode('utf-8')), '')
+        url = self.server_url + urljoin(quote(sdir.encode('utf-8')), '')
+        turl = self.server_url + urljoin('tiles',
+                                         quote(sdir.encode('utf-8')), '')
+
+        self.files = []
+        index = i = 0
+        for (fn, orig_orientation, file_type) in [de[:3] for de in files]:
+            fn = quote(fn.encode('utf-8'))
+            if fn[-4:].lower() in (".jpg", "jpeg"):
+                file_url = url + fn
+            else:
+                file_url = jurl + fn + '.jpg'
+            screen_url = jurl + fn + '.jpg?' + screen_query(orig_orientation)
+
+            orientation = orig_orientation
+            if platform == 'android':
+                orientation = {1: 8, 3: 6, 6: 6, 8: 8}[orig_orientation]
+
+            self.files.append({'source': screen_url, 'original': file_url,
+                               'tiles': turl + fn + '/',
+                               'orientation': orientation,
+                               'orig_orientation': orig_orientation})
+
+            if fn == self.filename:
+                index = i
+            i +=1
+
+        n = min(len(self.files), 2 * slide_window + 1)
+        self.first = max(0, min(index - slide_window, len(self.files) - n))
+        for i in range(self.first, self.first + n):
+            image = CachedImage(load=False, allow_scale=True,
+                                cache_kind=FULL)
+            image.bind(image_scale=self.on_image_scale)
+            self.bind_slide(image, i)
+            self.add_widget(image)
+
+        self.index = index - self.first
+
+    def bind_slide(self, image, i):
+        '''Show the file i in the slide image'''
+        image.release()
+        image.load = False  # Until _insert_visible_slides shows it
+        image.orig_orientation = self.files[i]['orig_orientation']
+        for k, v in self.files[i].items():
+            if k != 'orig_orientation':
+                setattr(image, k, v)
+
+    def on_index(self, *args):
+        super(ImageCarousel, self).on_index(*args)
+        self._trigger_recenter()
+
+    def recenter(self, *args):
+        '''Move the slides out of the window to its other side'''
+        if self.index is None or not self.slides:
+            return
+        current = self.first + self.index
+        self.prefetch(current)
+        n = len(self.slides)
+        first = max(0, min(current - slide_window, len(self.files) - n))
+        if first == self.first:
+            return
+        while self.first < first:
+            image = self.slides[0]
+            self.remove_widget(image)
+            self.bind_slide(image, self.first + n)
+            self.add_widget(image)
+            self.first += 1
+        while self.first > first:
+            image = self.slides[-1]
+            self.remove_widget(image)
+            self.first -= 1
+            self.bind_slide(image, self.first)
+            self.add_widget(image, len(self.slides))
+        self.index = current - self.first
+
+    def prefetch(self, current):
+        '''Warm the cache with the files after the loaded neighbours, in
+        the direction of the last swipe'''
+        d = carousel_prefetcher.move(current)
+        n = carousel_prefetcher.max_ahead
+        indices = [current + d * j for j in range(2, n + 2)]
+        carousel_prefetcher.want([self.files[i]['source'] for i in indices
+                                  if 0 <= i < len(self.files)])
+
+    def reload(self):
+        Logger.error("%s: Carousel reload not implemented" % APP)
+
+    def on_image_scale(self, widget, scale):
+        if scale > 1.0:
+            self.scroll_timeout = 1;
+        else:
+            self.scroll_timeout = 200;
+
+    def _insert_visible_slides(self, _next_slide=None, _prev_slide=None):
+        super(ImageCarousel, self)._insert_visible_slides(_next_slide,
+                                                          _prev_slide)
+        visible = []
+        for slide, priority in ((self._current, VISIBLE),
+                                (self._next, NEIGHBOUR),
+                                (self._prev, NEIGHBOUR)):
+            if slide:
+                image = slide.children[0]
+                image.priority = priority
+                image.load = True
+                image.resume()
+                visible.append(image)
+        for image in self.slides:
+            if image not in visible:
+                image.cancel()
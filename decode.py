@@ -0,0 +1,118 @@
+from threading import Thread
+from Queue import Queue
+from base64 import b64decode
+from io import BytesIO
+from functools import partial
+from time import time
+from threading import current_thread
+from kivy.clock import Clock
+from kivy.logger import Logger
+from kivy.graphics.texture import Texture
+from kivy.core.image import Image as CoreImage, ImageData, ImageLoader
+
+from perf import perf
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+APP = "KBDecode"
+
+default_workers = 2
+
+
+def load_image_data(fn, size=None):
+    '''Decode the image file fn, return its kivy ImageData
+
+    With PIL, jpegs are decoded at the smallest DCT scale still bigger than
+    size, which is much faster than decoding the whole image.
+    '''
+    if PILImage is None:
+        return ImageLoader.load(fn, keep_data=True, nocache=True)._data[0]
+    im = PILImage.open(fn)
+    if size:
+        im.draft('RGB', size)
+    if im.mode not in ('RGB', 'RGBA'):
+        im = im.convert('RGB')
+    return ImageData(im.size[0], im.size[1], im.mode.lower(), im.tobytes(),
+                     source=fn)
+
+
+def load_preview(preview):
+    '''Decode the base64 encoded jpeg preview of a listing, return its
+    texture, or None if it is not valid'''
+    try:
+        data = BytesIO(b64decode(preview))
+        if PILImage is None:
+            return CoreImage(data, ext='jpg', nocache=True).texture
+        im = PILImage.open(data).convert('RGB')
+    except Exception as e:
+        Logger.warning("%s: Unable to decode a preview: %s" % (APP, e))
+        return None
+    return Texture.create_from_data(ImageData(
+        im.size[0], im.size[1], 'rgb', im.tobytes()))
+
+
+class DecodeJob(object):
+
+    def __init__(self, fn, size, callback):
+        self.fn = fn
+        self.size = size
+        self.callback = callback
+        self.cancelled = False
+        self.started = self.ended = None
+        self.thread = None
+
+
+class Decoder(object):
+    '''Decodes image files in a pool of worker threads
+
+    The callback of every job gets the ImageData in the main thread, so only
+    the texture upload is left to do there, or None if the file could not
+    be decoded. Cancelled jobs are skipped, or their result dropped.
+    '''
+
+    def __init__(self, workers=default_workers):
+        self.queue = Queue()
+        self.workers = []
+        for i in range(workers):
+            t = Thread(target=self._run, name="Decoder-%d" % i)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def decode(self, fn, callback, size=None):
+        job = DecodeJob(fn, size, callback)
+        self.queue.put(job)
+        return job
+
+    def cancel(self, job):
+        job.cancelled = True
+
+    def stats(self):
+        return {'queued': self.queue.qsize()}
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job.cancelled:
+                continue
+            job.started = time()
+            job.thread = current_thread().name
+            try:
+                imdata = load_image_data(job.fn, job.size)
+            except Exception as e:
+                Logger.warning("%s: Unable to decode %s: %s" % (
+                    APP, job.fn, e))
+                imdata = None
+            job.ended = time()
+            Clock.schedule_once(partial(self._done, job, imdata), 0)
+
+    def _done(self, job, imdata, dt):
+        perf.latency('decode', job.started, job.ended, thread=job.thread,
+                     fn=job.fn)
+        if not job.cancelled:
+            job.callback(imdata)
+
+decoder = Decoder()
@@ -0,0 +1,285 @@
+from heapq import heappush, heappop
+from itertools import count
+from time import time
+from kivy.clock import Clock
+from kivy.logger import Logger
+
+from batch import PackParser, batch_url, thumb_batch
+from httppool import HttpRequest
+from perf import perf
+
+APP = "KBDownload"
+
+# Priorities, lower values are downloaded first
+VISIBLE = 0
+PREFETCH = 1
+NEIGHBOUR = 2
+AHEAD = 3  # Prefetched in case they are shown next
+
+default_max_workers = 4
+default_batch_size = 32
+
+# Batch responses meaning the server doesn't support them
+unsupported = (404, 405, 501)
+
+
+class Ticket(object):
+    '''A subscription to a download, returned by Scheduler.fetch'''
+
+    def __init__(self, download, on_success, on_failure):
+        self.download = download
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.cancelled = False
+
+
+class Download(object):
+
+    def __init__(self, url, file_path, priority):
+        self.url = url
+        self.file_path = file_path
+        self.priority = priority
+        self.tickets = []
+        self.req = None
+        self.queued = time()
+        self.no_batch = False  # Set after a failed batch
+
+    def live_tickets(self):
+        return [t for t in self.tickets if not t.cancelled]
+
+
+class BatchItem(object):
+    '''Stands for the request of a download done by a batch request, for
+    the ticket callbacks'''
+
+    def __init__(self, url, req):
+        self.url = url
+        self.resp_status = req.resp_status
+        self.resp_headers = {}
+
+
+class Scheduler(object):
+    '''Runs the image downloads with a bounded number of concurrent requests
+
+    Pending downloads are kept in a priority queue and de-duplicated by url.
+    Every caller gets a Ticket it can cancel, and a pending download is
+    dropped once all its tickets are cancelled, aborting its request if it
+    is already running.
+
+    With a batch function, returning the (batch url, name) a url can be
+    fetched with or None, up to batch_size queued downloads with the same
+    batch url are done by a single request, see PackParser. Batching is
+    disabled when the server doesn't support it, and the downloads of a
+    batch failing otherwise are queued again to be done one by one.
+    '''
+
+    def __init__(self, max_workers=default_max_workers, batch=None,
+                 batch_size=default_batch_size):
+        self.max_workers = max_workers
+        self.batch = batch
+        self.batch_size = batch_size
+        self.queue = []  # Heap of (priority, seq, download)
+        # Batch url -> heap of (priority, seq, name, download), the queued
+        # downloads that can be batched together
+        self.batch_queues = {}
+        self.pending = {}  # url -> Download, queued or running
+        self.running = set()
+        self.requests = set()  # Requests in progress
+        self.batches = 0
+        self.cancelled = 0  # Downloads dropped while queued
+        self.aborted = 0  # Requests cancelled while running
+        self._seq = count()
+        # Downloads are started at the end of the frame, so the ones asked
+        # for in the same frame can be batched
+        self._trigger_start = Clock.create_trigger(self._start_next, -1)
+
+    def set_max_workers(self, max_workers):
+        self.max_workers = max(1, max_workers)
+        self._start_next()
+
+    def fetch(self, url, on_success, on_failure=None, file_path=None,
+              priority=VISIBLE):
+        download = self.pending.get(url)
+        if download is None:
+            download = Download(url, file_path, priority)
+            self.pending[url] = download
+            self._push(download)
+        elif priority < download.priority and download.req is None:
+            download.priority = priority
+            self._push(download)
+        ticket = Ticket(download, on_success, on_failure)
+        download.tickets.append(ticket)
+        self._trigger_start()
+        return ticket
+
+    def cancel(self, ticket):
+        if ticket.cancelled:
+            return
+        ticket.cancelled = True
+        download = ticket.download
+        if download.live_tickets() or \
+                self.pending.get(download.url) is not download:
+            return
+        req = download.req
+        if req is None:
+            # Still queued, it will be skipped when popped from the heap
+            del self.pending[download.url]
+            self.cancelled += 1
+            return
+        downloads = getattr(req, 'downloads', None)
+        if downloads is not None and any(d.live_tickets()
+                                         for d in downloads.values()):
+            return  # Others still want the batch
+        req.cancel()
+        self.aborted += 1
+        self.requests.discard(req)
+        for d in (downloads.values() if downloads is not None else [download]):
+            self._finish(d)
+        self._trigger_start()
+
+    def set_batch(self, batch, batch_size=default_batch_size):
+        self.batch = batch
+        self.batch_size = batch_size
+        self.batch_queues = {}
+        for priority, seq, download in self.queue:
+            if self._queued(priority, download):
+                self._push_batch(priority, seq, download)
+
+    def _push(self, download):
+        seq = next(self._seq)
+        heappush(self.queue, (download.priority, seq, download))
+        self._push_batch(download.priority, seq, download)
+
+    def _push_batch(self, priority, seq, download):
+        batch = (self.batch and not download.no_batch and
+                 self.batch(download.url))
+        if batch:
+            heappush(self.batch_queues.setdefault(batch[0], []),
+                     (priority, seq, batch[1], download))
+
+    def _queued(self, priority, download):
+        return (priority == download.priority and download.req is None
+                and self.pending.get(download.url) is download)
+
+    def _start_next(self, *args):
+        while self.queue and len(self.requests) < self.max_workers:
+            priority, seq, download = heappop(self.queue)
+            if not self._queued(priority, download):
+                continue  # Stale heap entry
+            batch = (self.batch and not download.no_batch and
+                     self.batch(download.url))
+            group = self._batch_group(batch[0], download) if batch else []
+            if group:
+                self._start_batch(batch[0], [(batch[1], download)] + group)
+                continue
+            self.running.add(download)
+            download.req = req = HttpRequest(
+                url=download.url, file_path=download.file_path,
+                on_success=self._on_success, on_failure=self._on_failure,
+                on_error=self._on_failure)
+            req.download = download
+            self.requests.add(req)
+
+    def _batch_group(self, url, first):
+        '''Return the (name, download) of the queued downloads with the
+        batch url other than first, in priority order'''
+        group = []
+        queue = self.batch_queues.get(url, [])
+        while queue and len(group) < self.batch_size - 1:
+            priority, seq, name, download = heappop(queue)
+            if (download is not first and not download.no_batch and
+                    self._queued(priority, download)):
+                group.append((name, download))
+        if not queue:
+            self.batch_queues.pop(url, None)
+        return group
+
+    def _start_batch(self, url, group):
+        downloads = dict(group)
+        files = dict((name, d.file_path) for name, d in group)
+        req = HttpRequest(
+            url=batch_url(url, [name for name, d in group]),
+            parser=PackParser(files), on_progress=self._on_batch_items,
+            on_success=self._on_batch_done, on_failure=self._on_batch_done,
+            on_error=self._on_batch_done)
+        req.downloads = downloads
+        for d in downloads.values():
+            d.req = req
+            self.running.add(d)
+        self.requests.add(req)
+        self.batches += 1
+
+    def _finish(self, download):
+        if self.pending.get(download.url) is download:
+            del self.pending[download.url]
+        self.running.discard(download)
+        return download.live_tickets()
+
+    def _done(self, req):
+        self.requests.discard(req)
+        self._start_next()
+
+    def _on_success(self, req, res):
+        perf.latency('download', req.download.queued, time(), url=req.url)
+        self._done(req)
+        for ticket in self._finish(req.download):
+            ticket.on_success(req, res)
+
+    def _on_failure(self, req, res):
+        Logger.warning("%s: Download failed %s: %s" % (APP, req.url, res))
+        self._done(req)
+        for ticket in self._finish(req.download):
+            if ticket.on_failure:
+                ticket.on_failure(req, res)
+
+    def _on_batch_items(self, req, items):
+        for name, ok in items:
+            download = req.downloads.pop(name, None)
+            if download is None:
+                continue
+            item = BatchItem(download.url, req)
+            if ok:
+                perf.latency('download', download.queued, time(),
+                             url=download.url, batch=req.url)
+            for ticket in self._finish(download):
+                if ok:
+                    ticket.on_success(item, None)
+                elif ticket.on_failure:
+                    ticket.on_failure(item, None)
+
+    def _on_batch_done(self, req, res):
+        self.requests.discard(req)
+        if not req.resp_status or not 200 <= req.resp_status < 300:
+            # Queue the downloads again, to be done one by one
+            if req.resp_status in unsupported:
+                Logger.warning("%s: Batch failed %s: %s, batches disabled" % (
+                    APP, req.url, req.resp_status))
+                self.batch = None
+                self.batch_queues = {}
+            else:
+                Logger.warning("%s: Batch failed %s: %s" % (
+                    APP, req.url, res))
+            for download in req.downloads.values():
+                download.req = None
+                download.no_batch = True
+                self.running.discard(download)
+                if not download.live_tickets():
+                    self.pending.pop(download.url, None)
+                    continue
+                self._push(download)
+            req.downloads = {}
+        elif req.downloads:
+            # Missing from the response
+            self._on_batch_items(req, [(name, False)
+                                       for name in req.downloads.keys()])
+        self._start_next()
+
+    def stats(self):
+        return {'queued': len(self.pending) - len(self.running),
+                'running': len(self.running),
+                'requests': len(self.requests),
+                'batches': self.batches,
+                'cancelled': self.cancelled,
+                'aborted': self.aborted}
+
+scheduler = Scheduler(batch=thumb_batch)
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Stand-in for the gallery server, to try the app and its protocol locally
+
+Serves either a directory of the local filesystem or an in-memory gallery
+with the same urls as the real server:
+
+    /<dir>/              newline delimited json listing
+    /thumb/<dir>/<f>.jpg thumbnail of <dir>/<f>
+    /thumbs/<dir>/?n=<f>.jpg&n=...
+                         the thumbnails of several files of <dir>, packed as
+                         described in batch.PackParser
+    /jpeg/<dir>/<f>.jpg  jpeg conversion of <dir>/<f>, shrunk to fit inside
+                         ?w=<width>&h=<height> if given (needs PIL)
+    /tiles/<dir>/<f>/info                   size of the tiles pyramid of
+                                            <dir>/<f> (needs PIL)
+    /tiles/<dir>/<f>/<level>/<col>_<row>.jpg a tile of the pyramid
+    /<dir>/<f>           the original file
+
+Listings carry a version that is also their ETag. Requests with a matching
+If-None-Match get a 304, and ?since=<version> of a listing served before
+gets a delta with the changes only. The server can add latency to every
+request and limit the bandwidth of every connection, to stand in for a
+remote one.
+
+Usage: python fakeserver.py [port] [directory]
+'''
+import sys
+import socket
+from time import sleep
+from os import listdir
+from os.path import join, isdir, splitext
+from json import dumps
+from math import ceil
+from hashlib import sha1
+from base64 import b64encode
+from io import BytesIO
+from urllib import unquote
+from urlparse import urlsplit, parse_qs
+from threading import Thread, Lock
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from batch import pack_item
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+DIR = 'dir'
+FILE = 'file'
+
+image_exts = ('.jpg', '.jpeg', '.png', '.gif', '.tif', '.tiff', '.bmp')
+
+chunk_size = 16 * 1024  # Bytes written at a time with limited bandwidth
+
+
+def listing_version(direntries):
+    return sha1(dumps(direntries)).hexdigest()[:16]
+
+
+def resize(data, size):
+    '''Return the image data shrunk to fit inside size, as a jpeg'''
+    if PILImage is None:
+        return data
+    im = PILImage.open(BytesIO(data))
+    if im.size[0] <= size[0] and im.size[1] <= size[1]:
+        return data
+    im.draft('RGB', size)
+    im.thumbnail(size, PILImage.ANTIALIAS)
+    out = BytesIO()
+    im.convert('RGB').save(out, 'JPEG', quality=85)
+    return out.getvalue()
+
+
+def sample_jpeg(size=(640, 480)):
+    '''Return a generated gradient jpeg of size (needs PIL)'''
+    w, h = size
+    im = PILImage.new('RGB', size)
+    im.putdata([(x * 255 // w, y * 255 // h, 128)
+                for y in range(h) for x in range(w)])
+    out = BytesIO()
+    im.save(out, 'JPEG', quality=85)
+    return out.getvalue()
+
+
+def preview(data, size=(16, 16)):
+    '''Return the tiny base64 jpeg of the image data listings can carry'''
+    im = PILImage.open(BytesIO(data))
+    im.draft('RGB', size)
+    im.thumbnail(size, PILImage.ANTIALIAS)
+    out = BytesIO()
+    im.convert('RGB').save(out, 'JPEG', quality=50)
+    return b64encode(out.getvalue())
+
+
+class Gallery(object):
+    '''The directories and images served. Without a root directory the
+    gallery lives in memory and is filled with put_dir and put_image. With
+    previews set, the files of a root directory are listed with their
+    preview (needs PIL).'''
+
+    tile_size = 256
+
+    def __init__(self, root=None, previews=False):
+        self.root = root
+        self.previews = previews and PILImage is not None
+        self._previews = {}  # path -> preview
+        self.dirs = {}  # path -> direntries
+        self.images = {}  # path -> data
+        self.history = {}  # (path, version) -> direntries served before
+        self.lock = Lock()
+
+    def put_dir(self, path, direntries):
+        with self.lock:
+            self.dirs[path.strip('/')] = [list(de) for de in direntries]
+
+    def put_image(self, path, data):
+        with self.lock:
+            self.images[path.strip('/')] = data
+
+    def fill(self, path, n, data):
+        '''Put a directory of n files, all with the image data'''
+        path = path.strip('/')
+        names = ["img%06d.jpg" % i for i in range(n)]
+        self.put_dir(path, [[name, 1, FILE] for name in names])
+        with self.lock:
+            for name in names:
+                self.images[join(path, name)] = data
+
+    def direntries(self, path):
+        path = path.strip('/')
+        if self.root is None:
+            with self.lock:
+                return self.dirs.get(path)
+        fullpath = join(self.root, path)
+        if not isdir(fullpath):
+            return None
+        direntries = []
+        for name in sorted(listdir(fullpath)):
+            if name.startswith('.'):
+                continue
+            if isdir(join(fullpath, name)):
+                direntries.append([name, 1, DIR])
+            elif splitext(name)[1].lower() in image_exts:
+                de = [name, 1, FILE]
+                if self.previews:
+                    de.append(self.preview(join(path, name)))
+                direntries.append(de)
+        return direntries
+
+    def preview(self, path):
+        if path not in self._previews:
+            try:
+                self._previews[path] = preview(self.image(path))
+            except Exception:
+                self._previews[path] = ""
+        return self._previews[path]
+
+    def listing(self, path, since=None):
+        '''Return (version, body). The body is a delta if since is a
+        version of the listing served before'''
+        path = path.strip('/')
+        direntries = self.direntries(path)
+        if direntries is None:
+            return None, None
+        version = listing_version(direntries)
+        with self.lock:
+            self.history[(path, version)] = direntries
+            base = self.history.get((path, since))
+        sdir = path.decode('utf-8')
+        if base is None or since == version:
+            header = {'dir': sdir, 'version': version}
+            lines = direntries
+        else:
+            header = {'dir': sdir, 'version': version, 'base': since}
+            old = dict((de[0], de) for de in base)
+            names = set(de[0] for de in direntries)
+            lines = [de for de in direntries if old.get(de[0]) != de]
+            removed = [de[0] for de in base if de[0] not in names]
+            if removed:
+                lines.append({'removed': removed})
+        return version, "\n".join(
+            dumps(l) for l in [header] + lines) + "\n"
+
+    def image(self, path):
+        path = path.strip('/')
+        if self.root is None:
+            with self.lock:
+                return self.images.get(path)
+        try:
+            with open(join(self.root, path), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def thumb(self, path):
+        return self.image(path)
+
+    def jpeg(self, path, size=None):
+        data = self.image(path)
+        if data is not None and size:
+            data = resize(data, size)
+        return data
+
+    def tile_info(self, path):
+        data = self.image(path)
+        if data is None or PILImage is None:
+            return None
+        width, height = PILImage.open(BytesIO(data)).size
+        levels = 1
+        while max(width, height) > self.tile_size << (levels - 1):
+            levels += 1
+        return dumps({'width': width, 'height': height,
+                      'tile_size': self.tile_size, 'levels': levels})
+
+    def tile(self, path, level, col, row):
+        '''Tile of the image at level, shrunk by 2 ** level'''
+        data = self.image(path)
+        if data is None or PILImage is None:
+            return None
+        im = PILImage.open(BytesIO(data))
+        size = [int(ceil(v / 2. ** level)) for v in im.size]
+        ts = self.tile_size
+        box = (col * ts, row * ts,
+               min(size[0], (col + 1) * ts), min(size[1], (row + 1) * ts))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return None
+        if level:
+            im.draft('RGB', size)
+            im = im.resize(size, PILImage.ANTIALIAS)
+        out = BytesIO()
+        im.crop(box).convert('RGB').save(out, 'JPEG', quality=85)
+        return out.getvalue()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections.add(self.connection)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.connection)
+        BaseHTTPRequestHandler.finish(self)
+
+    def do_GET(self):
+        if self.server.latency:
+            sleep(self.server.latency)
+        gallery = self.server.gallery
+        scheme, netloc, path, query, fragment = urlsplit(self.path)
+        path = unquote(path).lstrip('/')
+        args = parse_qs(query)
+        self.server.count(path)
+
+        if path.startswith('thumbs/'):
+            sdir = path[len('thumbs/'):]
+            body = "".join(
+                pack_item(n, gallery.thumb((sdir + unquote(n))[:-4]))
+                for n in args.get('n', []))
+            return self.send(200, body,
+                             {'Content-Type': 'application/octet-stream'})
+
+        if not path or path.endswith('/'):
+            since = args.get('since', [None])[0]
+            version, body = gallery.listing(path, since)
+            if body is None:
+                return self.send(404, "Not found")
+            etag = '"%s"' % version
+            if self.headers.get('If-None-Match') == etag:
+                return self.send(304, None, {'ETag': etag})
+            return self.send(200, body, {'ETag': etag,
+                                         'Content-Type': 'text/plain'})
+
+        kind, rest = (path.split('/', 1) + [''])[:2]
+        if kind == 'thumb':
+            data = gallery.thumb(rest[:-4])  # Without the added .jpg
+        elif kind == 'tiles':
+            data = self.tile(gallery, rest)
+        elif kind == 'jpeg':
+            size = None
+            if 'w' in args and 'h' in args:
+                size = (int(args['w'][0]), int(args['h'][0]))
+            data = gallery.jpeg(rest[:-4], size)
+        else:
+            data = gallery.image(path)
+        if data is None:
+            return self.send(404, "Not found")
+        ctype = 'application/json' if path.endswith('/info') else 'image/jpeg'
+        self.send(200, data, {'Content-Type': ctype})
+
+    def tile(self, gallery, rest):
+        if rest.endswith('/info'):
+            return gallery.tile_info(rest[:-5])
+        try:
+            path, level, name = rest.rsplit('/', 2)
+            col, row = name[:-4].split('_')
+            return gallery.tile(path, int(level), int(col), int(row))
+        except ValueError:
+            return None
+
+    def send(self, status, body, headers={}):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body or "")))
+        self.end_headers()
+        if body:
+            self.write(body)
+
+    def write(self, body):
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            return self.wfile.write(body)
+        for i in xrange(0, len(body), chunk_size):
+            chunk = body[i:i + chunk_size]
+            self.wfile.write(chunk)
+            sleep(len(chunk) / float(bandwidth))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    '''Threaded server for a Gallery. Use port 0 to get a free port.
+    latency is in seconds, and bandwidth in bytes per second per connection,
+    None for unlimited.'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, gallery, port=0, verbose=False, latency=0,
+                 bandwidth=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.gallery = gallery
+        self.verbose = verbose
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = {}  # path -> number of requests
+        self.connections = set()  # Open client connections
+        self.lock = Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_port
+
+    def count(self, path):
+        self.requests[path] = self.requests.get(path, 0) + 1
+
+    def start(self):
+        '''Serve from a background thread'''
+        t = Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        '''Stop serving, and close the connections kept alive'''
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            connections = list(self.connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8888
+    root = sys.argv[2] if len(sys.argv) > 2 else '.'
+    server = FakeServer(Gallery(root, previews=True), port, verbose=True)
+    print "Serving %s at %s" % (root, server.url)
+    server.serve_forever()
@@ -0,0 +1,196 @@
+from kivy.clock import Clock
+from kivy.graphics import Color, Rectangle
+from kivy.properties import BooleanProperty, ListProperty, NumericProperty
+from kivy.uix.widget import Widget
+from kivy.uix.scrollview import ScrollView
+
+from download import VISIBLE, PREFETCH
+
+settle_delay = 0.1  # Seconds without scrolling to consider it stopped
+
+
+class RecycleGrid(ScrollView):
+    '''Virtualized grid of items, with a fixed pool of cell widgets
+
+    The number of columns follows the width, so cells are about cell_width
+    wide, and cells are cell_ratio times as high as wide. Only the visible
+    rows, plus overscan rows above and below them, have cell widgets. Cells
+    scrolled out of view are released with unbind_cell(cell) and rebound to
+    the items scrolled in with bind_cell(cell, item). Subclasses implement
+    bind_cell, the other hooks do nothing by default. Cells need a priority
+    property, set to VISIBLE or PREFETCH depending on their row being
+    visible or not, and a defer property, set once the grid scrolls faster
+    than defer_speed rows per second, by a drag or a fling, until it slows
+    to half of it or stops, so that images are only decoded once the rows
+    settle. The visible cells are the first ones to be let go then.
+    '''
+
+    cell_width = NumericProperty(160)
+    cell_ratio = NumericProperty(1.)
+    spacing = NumericProperty(0)
+    overscan = NumericProperty(1)
+    background_color = ListProperty([0, 0, 0, 0])
+    cols = NumericProperty(1)
+    row_height = NumericProperty(1)
+    defer_speed = NumericProperty(8)
+    fast = BooleanProperty(False)
+
+    def __init__(self, cell_cls, **kwargs):
+        self.cell_cls = cell_cls
+        self.items = []
+        self.cells = {}  # item index -> cell
+        self.free = []  # Cells not bound to any visible item
+        self._last_scroll = None  # (time, top offset) of the last layout
+        self._visible = (0, -1)  # First and last visible rows
+
+        super(RecycleGrid, self).__init__(do_scroll_x=False, **kwargs)
+        self.scroll_timeout = 500
+        self.scroll_distance = 5
+
+        self.container = Widget(size_hint_y=None, height=0)
+        with self.container.canvas.before:
+            self._bg_color = Color(*self.background_color)
+            self._bg = Rectangle()
+        self.add_widget(self.container)
+
+        self._trigger_layout = Clock.create_trigger(self._layout, -1)
+        self.bind(size=self._resize, cell_width=self._resize,
+                  cell_ratio=self._resize, spacing=self._resize,
+                  scroll_y=self._trigger_layout,
+                  background_color=self.update_background)
+        self.container.bind(pos=self.update_background,
+                            size=self.update_background)
+        self.bind(fast=self._update_defer)
+
+    def update_background(self, *args):
+        self._bg_color.rgba = self.background_color
+        self._bg.pos = self.container.pos
+        self._bg.size = self.container.size
+
+    def _top_offset(self):
+        '''Distance from the top of the content to the top of the view'''
+        scrollable = max(0, self.container.height - self.height)
+        return (1 - self.scroll_y) * scrollable
+
+    def _set_top_offset(self, top):
+        scrollable = self.container.height - self.height
+        if scrollable > 0:
+            self.scroll_y = 1 - min(1., max(0., top / scrollable))
+
+    def _resize(self, *args):
+        top_item = int(self._top_offset() // self.row_height) * self.cols
+        self.cols = max(1, int(round(self.width / float(self.cell_width))))
+        self.row_height = (self.width / float(self.cols)) * self.cell_ratio
+        self._update_height(top_item // self.cols * self.row_height)
+        # Every cell has to be placed again
+        self._release(set(self.cells))
+        self._trigger_layout()
+
+    def _update_height(self, top):
+        rows = (len(self.items) + self.cols - 1) // self.cols
+        self.container.height = rows * self.row_height
+        self._set_top_offset(top)
+
+    def set_items(self, items):
+        '''Show items, keeping the scroll position. Only the cells of the
+        items that changed are bound again'''
+        old = self.items
+        top = self._top_offset()
+        self.items = items
+        self._update_height(top)
+        changed = set(i for i in self.cells
+                      if i >= len(items) or i >= len(old) or
+                      old[i] != items[i])
+        self._release(changed)
+        self._trigger_layout()
+
+    def _release(self, indices):
+        for i in indices:
+            cell = self.cells.pop(i)
+            cell.item_index = None
+            self.unbind_cell(cell)
+            # Out of the way of the touches
+            cell.pos = (-10 * cell.width, -10 * cell.height)
+            self.free.append(cell)
+
+    def _layout(self, *args):
+        if not self.items or self.row_height <= 1:
+            return
+        cols, rh = self.cols, self.row_height
+        top = self._top_offset()
+        first = int(top // rh)
+        last = int((top + self.height) // rh)
+        self._visible = (first, last)
+        self._measure_speed(top)
+        start = max(0, (first - self.overscan) * cols)
+        end = min(len(self.items), (last + 1 + self.overscan) * cols)
+
+        self._release([i for i in self.cells if not start <= i < end])
+
+        container = self.container
+        cw = self.width / float(cols)
+        sp = self.spacing
+        for i in xrange(start, end):
+            cell = self.cells.get(i)
+            if cell is None:
+                cell = self.free.pop() if self.free else self._new_cell()
+                self.cells[i] = cell
+                cell.item_index = i
+                cell.defer = self.fast
+                self.bind_cell(cell, self.items[i])
+            row, col = divmod(i, cols)
+            cell.priority = VISIBLE if first <= row <= last else PREFETCH
+            cell.size = (cw - sp, rh - sp)
+            cell.pos = (container.x + col * cw + sp / 2.,
+                        container.top - (row + 1) * rh + sp / 2.)
+        self.rows_shown(first, last)
+
+    def _measure_speed(self, top):
+        now = Clock.get_time()
+        if self._last_scroll is not None:
+            t, last_top = self._last_scroll
+            if now > t:
+                speed = abs(top - last_top) / self.row_height / (now - t)
+                # Hysteresis, so a speed around defer_speed doesn't flip
+                # the cells between deferred and loading on every frame
+                if speed > self.defer_speed:
+                    self.fast = True
+                elif speed < self.defer_speed / 2.:
+                    self.fast = False
+        self._last_scroll = (now, top)
+        Clock.unschedule(self._settled)
+        if self.fast:
+            Clock.schedule_once(self._settled, settle_delay)
+
+    def _settled(self, *args):
+        self.fast = False
+        self._last_scroll = None
+
+    def _update_defer(self, widget, fast):
+        '''Defer the cells, or let them load, visible rows first'''
+        first, last = self._visible
+        cols = self.cols
+        for i in sorted(self.cells, key=lambda i: not
+                        first <= i // cols <= last):
+            self.cells[i].defer = fast
+
+    def _new_cell(self):
+        cell = self.cell_cls(size_hint=(None, None))
+        cell.item_index = None
+        cell.bind(on_release=self._cell_released)
+        self.container.add_widget(cell)
+        return cell
+
+    def _cell_released(self, cell):
+        if cell.item_index is not None:
+            self.item_selected(self.items[cell.item_index])
+
+    def unbind_cell(self, cell):
+        pass
+
+    def rows_shown(self, first, last):
+        '''Called after every layout with the visible rows'''
+        pass
+
+    def item_selected(self, item):
+        pass
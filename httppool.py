@@ -0,0 +1,239 @@
+import socket
+from os import unlink
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+from urlparse import urlsplit, urljoin
+from threading import Thread, Condition
+from functools import partial
+from kivy.logger import Logger
+from kivy.clock import Clock
+
+APP = "KBHttp"
+
+default_max_per_host = 4
+timeout = 30
+chunk_size = 16384
+parser_chunk_size = 4096  # Smaller reads get parsed results out sooner
+max_redirects = 5
+
+
+class Cancelled(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    '''Persistent HTTP/1.1 connections, shared by all the requests
+
+    At most max_per_host connections are open to the same host. Requests
+    beyond that wait until a connection is released.
+    '''
+
+    def __init__(self, max_per_host=default_max_per_host):
+        self.max_per_host = max_per_host
+        self.idle = {}  # (scheme, netloc) -> [connections]
+        self.count = {}  # (scheme, netloc) -> open connections
+        self.lock = Condition()
+        self.requests = 0
+        self.reused = 0
+        self.opened = 0
+        self.cancelled = 0
+
+    def set_max_per_host(self, max_per_host):
+        with self.lock:
+            self.max_per_host = max(1, max_per_host)
+            self.lock.notify_all()
+
+    def acquire(self, scheme, netloc):
+        '''Return a (connection, reused) tuple for the host'''
+        host = (scheme, netloc)
+        with self.lock:
+            while True:
+                idle = self.idle.get(host)
+                if idle:
+                    self.requests += 1
+                    self.reused += 1
+                    return idle.pop(), True
+                if self.count.get(host, 0) < self.max_per_host:
+                    self.count[host] = self.count.get(host, 0) + 1
+                    self.requests += 1
+                    self.opened += 1
+                    break
+                self.lock.wait()
+        cls = HTTPSConnection if scheme == 'https' else HTTPConnection
+        return cls(netloc, timeout=timeout), False
+
+    def release(self, scheme, netloc, conn):
+        '''Return a connection whose response was fully read'''
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append(conn)
+            self.lock.notify()
+
+    def discard(self, scheme, netloc, conn):
+        conn.close()
+        with self.lock:
+            self.count[(scheme, netloc)] -= 1
+            self.lock.notify()
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests,
+                    'connections': self.opened,
+                    'reused': self.reused,
+                    'cancelled': self.cancelled,
+                    'reuse_rate': (float(self.reused) / self.requests
+                                   if self.requests else 0.)}
+
+pool = ConnectionPool()
+
+
+class HttpRequest(Thread):
+    '''Drop-in for the subset of UrlRequest used by the app, but going
+    through the persistent connections of the pool.
+
+    Callbacks are called from the main thread: on_success(req, result) for
+    2xx and 304 Not Modified responses, on_failure(req, result) for other
+    statuses and on_error(req, error) when the request couldn't be done.
+    When file_path is given the body is written there and result is None.
+
+    A parser with feed(data) and close() methods returning lists of parsed
+    items can be given to process a successful response while it arrives.
+    Its results are passed to on_progress(req, items).
+
+    cancel() aborts the request, even in the middle of reading the response,
+    and no callback is called after it.
+    '''
+
+    def __init__(self, url, on_success=None, on_failure=None, on_error=None,
+                 file_path=None, req_headers=None, parser=None,
+                 on_progress=None):
+        super(HttpRequest, self).__init__()
+        self.daemon = True
+        self.url = url
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.on_error = on_error
+        self.file_path = file_path
+        self.req_headers = req_headers or {}
+        self.parser = parser
+        self.on_progress = on_progress
+        self.resp_status = None
+        self.resp_headers = None
+        self.cancelled = False
+        self._conn = None  # Connection in use
+        self.start()
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        with pool.lock:
+            pool.cancelled += 1
+        conn = self._conn
+        sock = conn and conn.sock
+        if sock:
+            # Wake up the read blocked in the request thread
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def run(self):
+        url = self.url
+        try:
+            for i in range(max_redirects):
+                result = self._fetch(url)
+                if self.resp_status in (301, 302, 303, 307):
+                    url = urljoin(url, self.resp_headers['location'])
+                    continue
+                break
+        except Exception as e:
+            if self.cancelled:
+                Logger.debug("%s: Cancelled %s" % (APP, url))
+                return
+            Logger.warning("%s: Error requesting %s: %s" % (APP, url, e))
+            self._dispatch(self.on_error, e)
+            return
+        if self.cancelled:
+            return
+        if 200 <= self.resp_status < 300 or self.resp_status == 304:
+            self._dispatch(self.on_success, result)
+        else:
+            self._dispatch(self.on_failure, result)
+
+    def _fetch(self, url):
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        path = path or '/'
+        if query:
+            path += '?' + query
+        for attempt in (0, 1):
+            conn, reused = pool.acquire(scheme, netloc)
+            if self.cancelled:
+                pool.release(scheme, netloc, conn)
+                raise Cancelled()
+            self._conn = conn
+            try:
+                conn.request('GET', path, headers=self.req_headers)
+                resp = conn.getresponse()
+            except (HTTPException, socket.error):
+                pool.discard(scheme, netloc, conn)
+                if reused and not attempt:
+                    continue  # The server closed the idle connection
+                raise
+            break
+        try:
+            self.resp_status = resp.status
+            self.resp_headers = dict(resp.getheaders())
+            result = self._read(resp)
+        except:
+            pool.discard(scheme, netloc, conn)
+            raise
+        finally:
+            self._conn = None
+        if resp.will_close:
+            pool.discard(scheme, netloc, conn)
+        else:
+            pool.release(scheme, netloc, conn)
+        return result
+
+    def _read(self, resp):
+        if self.file_path and 200 <= resp.status < 300:
+            try:
+                with open(self.file_path, 'wb') as f:
+                    while True:
+                        chunk = resp.read(chunk_size)
+                        if self.cancelled:
+                            raise Cancelled()
+                        if not chunk:
+                            return None
+                        f.write(chunk)
+            except:
+                try:
+                    unlink(self.file_path)  # Don't leave half a file
+                except OSError:
+                    pass
+                raise
+        parser = self.parser if 200 <= resp.status < 300 else None
+        chunks = []
+        while True:
+            chunk = resp.read(parser_chunk_size if parser else chunk_size)
+            if self.cancelled:
+                raise Cancelled()
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if parser:
+                self._parsed(parser.feed(chunk))
+        if parser:
+            self._parsed(parser.close())
+        return "".join(chunks)
+
+    def _parsed(self, items):
+        if items:
+            self._dispatch(self.on_progress, items)
+
+    def _dispatch(self, callback, result):
+        if callback:
+            Clock.schedule_once(partial(self._callback, callback, result), 0)
+
+    def _callback(self, callback, result, dt):
+        if not self.cancelled:
+            callback(self, result)
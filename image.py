@@ -1,50 +1,73 @@
-import errno
-from os import makedirs, unlink
-from zlib import crc32
-from shutil import rmtree
-from os.path import join, dirname
+from functools import partial
+from os import unlink
+from os.path import getsize
 from kivy.logger import Logger
-from kivy.clock import Clock
-from kivy.graphics import PushMatrix, Rotate, PopMatrix
+from kivy.graphics import Color, Rectangle, PushMatrix, Rotate, PopMatrix
 from kivy.properties import AliasProperty, BooleanProperty, NumericProperty, ObjectProperty, StringProperty
+from kivy.core.window import Window
+from kivy.graphics.texture import Texture
 from kivy.uix.image import Image
+from kivy.uix.widget import Widget
 from kivy.uix.scatter import Scatter
 from kivy.animation import Animation
 from kivy.uix.stencilview import StencilView
 from kivy.uix.floatlayout import FloatLayout
-from kivy.network.urlrequest import UrlRequest
-
-APP = "KBImage"
-
-cache_root = ".kbimgcache"
-
-max_image_load_count = 1
-image_load_count = max_image_load_count
 
+from atlas import atlas
+from cache import DiskCache, THUMB, make_parent_dir
+from decode import decoder, load_preview
+from download import scheduler, VISIBLE
+from perf import perf
+from texcache import texcache
+from tiles import TileLayer
 
-def reset_image_load_count(dt):
-    global image_load_count
-    image_load_count = max_image_load_count
+APP = "KBImage"
 
-trigger_reset = Clock.create_trigger(reset_image_load_count)
+screens_cached = 8  # Screen sized images kept decoded by default
 
+cache_root = ".kbimgcache"
+diskcache = DiskCache(cache_root)
 
 def set_cache_dir(root):
     global cache_root
     cache_root = root
+    diskcache.set_root(root)
 
 
 def get_cache_dir():
     return cache_root
 
 
+def set_cache_budget(kind, budget):
+    diskcache.set_budget(kind, budget)
+
+
+def set_texture_budget(budget):
+    '''Memory kept for decoded images, 0 for enough to hold screens_cached
+    screens'''
+    if not budget:
+        w, h = Window.size
+        budget = screens_cached * w * h * 4
+    texcache.set_budget(budget)
+
+
 def clear_cache():
-    try:
-        rmtree(cache_root)
-        Logger.info("%s: Cleared cache dir %s" % (APP, cache_root))
-    except OSError as e:
-        if e.errno != errno.ENOENT:
-            raise
+    diskcache.clear()
+    atlas.clear()
+    texcache.clear()
+
+
+def cancel_downloads(widget):
+    '''Cancel the pending downloads of the cached images inside widget'''
+    for w in widget.walk(restrict=True):
+        if isinstance(w, CachedSource):
+            w.cancel()
+
+
+def resume_downloads(widget):
+    for w in widget.walk(restrict=True):
+        if isinstance(w, CachedSource):
+            w.resume()
 
 
 class RotImage(Image):
@@ -142,21 +165,187 @@ class RotImage(Image):
         Animation(color=(1, 1, 1, 1), duration=0.2).start(self)
 
 
-class CachedImage(FloatLayout, StencilView):
+class CachedSource(object):
+    '''Mixin for widgets showing an image downloaded to the disk cache
+
+    The source url is looked up in the texture cache, then in the disk cache
+    and downloaded through the scheduler when missing, and decoded by the
+    decoder worker threads. While defer is set downloads go on, but the
+    files are only decoded once it is cleared. Widgets call on_source once
+    they can display images, and implement show_texture(texture) and
+    hide_file(). show_data(fn, imdata) can be overridden to upload the
+    decoded images some other way.
+    '''
+
+    source = StringProperty("", allownone=True)
+    load = BooleanProperty(True)
+    cache_kind = StringProperty(THUMB)
+    priority = NumericProperty(VISIBLE)
+    defer = BooleanProperty(False)
+
+    ticket = None  # Pending download
+    decode_job = None
+    deferred = None  # File to decode once not deferred
+    fn = None
+    cached_file = False  # Set while fn was found in the disk cache
+    ready = False  # Set by the widget once it can display images
+
+    def on_source(self, widget, source):
+        if not source or not self.ready or not self.load:
+            return
+        self.cancel()
+        self.cancel_decode()
+        self.hide_file()
+        if self.show_cached():
+            self.fn = None
+            return
+        self.show_placeholder()
+        fn = diskcache.lookup(self.cache_kind, source)
+        self.cached_file = bool(fn)
+        if fn:
+            self.fn = fn
+            self.show_file(fn)
+        else:
+            self.download()
+
+    def download(self):
+        '''Fetch the source into the disk cache, then show it'''
+        self.cached_file = False
+        self.fn = fn = diskcache.path(self.cache_kind, self.source)
+        make_parent_dir(fn)
+        self.ticket = scheduler.fetch(self.source, self.img_downloaded,
+                                      on_failure=self.cleanup,
+                                      file_path=fn, priority=self.priority)
+
+    def cancel(self):
+        if self.ticket:
+            scheduler.cancel(self.ticket)
+
+    def resume(self):
+        if self.ticket and self.ticket.cancelled:
+            self.ticket = None
+            self.on_source(self, self.source)
+
+    def on_priority(self, widget, priority):
+        ticket = self.ticket
+        if ticket and not ticket.cancelled:
+            # Fetching again moves the download up the queue if needed
+            self.ticket = scheduler.fetch(self.source, self.img_downloaded,
+                                          on_failure=self.cleanup,
+                                          file_path=self.fn,
+                                          priority=priority)
+            scheduler.cancel(ticket)
+
+    def on_load(self, widget, load):
+        if not load or not self.source:
+            return
+        self.on_source(self, self.source)
+
+    def img_downloaded(self, req, res):
+        Logger.debug("%s: img_downloaded %s %s" % (APP, req, res))
+        self.ticket = None
+        headers = req.resp_headers or {}
+        try:
+            diskcache.add(self.cache_kind, req.url, getsize(self.fn),
+                          etag=headers.get('etag'),
+                          mtime=headers.get('last-modified'))
+        except OSError:
+            pass
+        self.show_file(self.fn)
+
+    def cleanup(self, *args):
+        self.ticket = None
+        try:
+            unlink(self.fn)
+        except:
+            pass
+
+    def decode_size(self):
+        '''Size the image is decoded for, None for the full size'''
+        return None
+
+    def cache_key(self):
+        '''Key of the decoded source in the texture cache'''
+        return self.source, self.decode_size()
+
+    def show_cached(self):
+        '''Show the source if it is still decoded in memory, return True if
+        it was'''
+        texture = texcache.get(self.cache_key())
+        if texture is None:
+            return False
+        self.show_texture(texture)
+        return True
+
+    def on_defer(self, widget, defer):
+        if not defer and self.deferred:
+            self.show_file(self.deferred)
+
+    def show_file(self, fn):
+        self.cancel_decode()
+        if self.defer:
+            self.deferred = fn
+            return
+        self.decode_job = decoder.decode(fn, partial(self.decoded, fn),
+                                         self.decode_size())
+
+    def cancel_decode(self):
+        self.deferred = None
+        if self.decode_job:
+            decoder.cancel(self.decode_job)
+            self.decode_job = None
+
+    def decoded(self, fn, imdata):
+        self.decode_job = None
+        if fn != self.fn:
+            return
+        if imdata is not None:
+            self.show_data(fn, imdata)
+        elif self.cached_file:
+            # Removed or damaged since it was indexed, download it again
+            Logger.warning("%s: Unable to decode cached %s, downloading it" % (
+                APP, self.source))
+            diskcache.discard(self.cache_kind, self.source)
+            self.download()
+
+    def show_placeholder(self):
+        '''Show something while the source is loaded'''
+        pass
+
+    def show_data(self, fn, imdata):
+        '''Upload the decoded imdata of fn and show it'''
+        texture = Texture.create_from_data(imdata)
+        texcache.add(self.cache_key(), texture)
+        self.show_texture(texture)
+
+    def hide_file(self):
+        pass
+
+
+class CachedImage(CachedSource, FloatLayout, StencilView):
+    '''Zoomable cached image, used by the carousel
+
+    The source can be a variant of the image sized for the screen, and
+    original the url of the full size image, loaded instead when zoomed
+    past 1:1. If tiles is the url of the image pyramid, its tiles are drawn
+    over the image instead, see TileLayer.
+    '''
 
     x = NumericProperty()
     y = NumericProperty()
     angle = NumericProperty(0)
     orientation = NumericProperty(1)
-    source = StringProperty("", allownone=True)
     image = ObjectProperty()
     scatter = ObjectProperty()
-    load = BooleanProperty(True)
     allow_scale = BooleanProperty(False)
     image_scale = NumericProperty(1.0)  # To be used by parent widgets
     fill = BooleanProperty(False)
+    original = StringProperty("")
+    tiles = StringProperty("")
 
     def __init__(self, **kwargs):
+        self.upgrading = False  # Showing source until original is loaded
+        self.tile_layer = None
         super(CachedImage, self).__init__(**kwargs)
 
         self.scatter = Scatter(do_rotation=False,
@@ -171,7 +360,11 @@ class CachedImage(FloatLayout, StencilView):
 
         self.bind(pos=self.update_pos, size=self.update_size,
                   fill=self.update_fill, orientation=self.update_orientation)
+        self.image.bind(center=self.update_tile_layer,
+                        norm_image_size=self.update_tile_layer,
+                        angle=self.update_tile_layer)
 
+        self.ready = True
         self.on_source(self, self.source)
         self.on_allow_scale(self, self.allow_scale)
         self.update_fill(self, self.fill)
@@ -204,47 +397,226 @@ class CachedImage(FloatLayout, StencilView):
             scatter.scale = 1.0
             scatter.do_translation = False
             scatter.apply_transform(scatter.transform_inv)
+            self.remove_tile_layer()
         elif scale > 1 and self.allow_scale:
             scatter.do_translation = True
+            self.load_detail()
+
+    def load_detail(self):
+        '''Show more detail than the screen sized source'''
+        if self.tiles:
+            if self.tile_layer is None:
+                self.tile_layer = TileLayer(self.tiles, self, self.scatter,
+                                            diskcache,
+                                            on_failure=self.tiles_failed)
+                self.image.add_widget(self.tile_layer)
+                self.update_tile_layer()
+        elif self.original and self.source != self.original:
+            self.upgrading = True
+            self.source = self.original
 
-    def on_source(self, widget, source):
-        if not source or not self.image or not self.load:
-            return
-        fn = "{0:x}.jpg".format(crc32(source) & 0xffffffff)
-        self.fn = fn = join(cache_root, fn[:2], fn)
-        try:
-            open(fn)  # Keep for reference: getattr(os.lstat(fn), 'st_size')
-            # Try to load at most one image per frame
-            Clock.schedule_once(self.set_image_source, 0)
-        except:
-            try:
-                makedirs(dirname(fn))
-            except OSError as exception:
-                if exception.errno != errno.EEXIST:
-                    raise
-            UrlRequest(url=source, on_success=self.img_downloaded, file_path=fn,
-                       on_failure=self.cleanup, on_error=self.cleanup)
-
-    def set_image_source(self, dt):
-        global image_load_count
-        if image_load_count:
-            self.image.source = self.fn
-            image_load_count -= 1
-            trigger_reset()
+    def cleanup(self, *args):
+        super(CachedImage, self).cleanup(*args)
+        self.upgrading = False  # Keep showing source
+
+    def decoded(self, fn, imdata):
+        super(CachedImage, self).decoded(fn, imdata)
+        if imdata is None and fn == self.fn and self.ticket is None:
+            self.upgrading = False  # Not downloading it again
+
+    def release(self):
+        '''Stop loading and drop the texture, before showing another
+        image'''
+        self.cancel()
+        self.cancel_decode()
+        self.upgrading = False
+        self.remove_tile_layer()
+        self.scatter.scale = 1.0
+        Animation.cancel_all(self.image)
+        self.image.color = (0, 0, 0, 1)
+        self.image.texture = None
+
+    def tiles_failed(self, layer):
+        self.remove_tile_layer()
+        self.tiles = ""
+        self.load_detail()
+
+    def update_tile_layer(self, *args):
+        layer = self.tile_layer
+        if layer:
+            layer.angle = self.image.angle
+            layer.size = self.image.norm_image_size
+            layer.center = self.image.center
+
+    def remove_tile_layer(self):
+        if self.tile_layer:
+            self.tile_layer.clear()
+            self.image.remove_widget(self.tile_layer)
+            self.tile_layer = None
+
+    def decode_size(self):
+        if self.source == self.original:
+            return None
+        w, h = Window.size
+        if self.orientation in (6, 8):
+            w, h = h, w
+        return w, h
+
+    def show_texture(self, texture):
+        self.image.texture = texture
+        if self.upgrading:
+            self.upgrading = False
         else:
-            Clock.schedule_once(self.set_image_source, 0)
+            Animation(color=(1, 1, 1, 1), duration=0.2).start(self.image)
 
-    def on_load(self, widget, load):
-        if not load or not self.source:
+    def hide_file(self):
+        if self.upgrading:
             return
+        self.remove_tile_layer()
+        if self.image.texture:
+            # Recycled for another image, hide the previous one
+            Animation.cancel_all(self.image)
+            self.image.color = (0, 0, 0, 1)
+
+
+# Texture corners, as (u, v) in the unit square, for the bottom left, bottom
+# right, top right and top left corners of the widget, by exif orientation
+_corners = {1: ((0, 0), (1, 0), (1, 1), (0, 1)),
+            3: ((1, 1), (0, 1), (0, 0), (1, 0)),
+            6: ((1, 0), (1, 1), (0, 1), (0, 0)),
+            8: ((0, 1), (0, 0), (1, 0), (1, 1))}
+
+
+def tex_coords(texture, orientation, width, height, fill=True):
+    '''Return the tex_coords that show texture rotated by its exif
+    orientation, and cropped to the width / height ratio if fill is set'''
+    tw, th = texture.size
+    rotated = orientation in (6, 8)
+    iw, ih = (th, tw) if rotated else (tw, th)  # Displayed image size
+    fx = fy = 1.
+    if fill and width and height and iw and ih:
+        ratio, cell_ratio = float(iw) / ih, float(width) / height
+        if ratio > cell_ratio:
+            fx = cell_ratio / ratio
+        else:
+            fy = ratio / cell_ratio
+    fu, fv = (fy, fx) if rotated else (fx, fy)
+    u0, u1 = (1 - fu) / 2, (1 + fu) / 2
+    v0, v1 = (1 - fv) / 2, (1 + fv) / 2
+
+    # Map the unit square into the texture own coordinates, which can be
+    # flipped or a region of a bigger texture
+    t = texture.tex_coords
+    coords = []
+    for a, b in _corners.get(orientation, _corners[1]):
+        u, v = (u1 if a else u0), (v1 if b else v0)
+        coords.append(t[0] + u * (t[2] - t[0]) + v * (t[6] - t[0]))
+        coords.append(t[1] + u * (t[3] - t[1]) + v * (t[7] - t[1]))
+    return coords
+
+
+class Thumbnail(CachedSource, Widget):
+    '''Flat cached image for the grids
+
+    Draws the texture with a single rectangle, rotated by its exif
+    orientation and cropped to fill the widget through its tex_coords,
+    without the scatter and stencil of CachedImage. The preview of the
+    listing, if any, is drawn the same way while the thumbnail loads.
+    '''
+
+    orientation = NumericProperty(1)
+    preview = StringProperty("")  # Base64 jpeg from the listing
+    fill = BooleanProperty(True)
+    brightness = NumericProperty(0)  # Faded in when the image is shown
+
+    def __init__(self, **kwargs):
+        super(Thumbnail, self).__init__(**kwargs)
+
+        self.texture = None
+        self.atlas_key = None  # Set while the texture is an atlas region
+        with self.canvas:
+            self._color = Color(0, 0, 0, 1)
+            self._rect = Rectangle()
+
+        self.bind(pos=self.update_rect, size=self.update_rect,
+                  orientation=self.update_rect, fill=self.update_rect,
+                  brightness=self.update_color)
+
+        self.ready = True
         self.on_source(self, self.source)
 
-    def img_downloaded(self, req, res):
-        Logger.debug("%s: img_downloaded %s %s" % (APP, req, res))
-        self.image.source = self.fn
+    def update_color(self, i, brightness):
+        self._color.rgb = (brightness, brightness, brightness)
 
-    def cleanup(self, *args):
-        try:
-            unlink(self.fn)
-        except:
-            pass
+    def update_rect(self, *args):
+        texture = self.texture
+        if texture is None:
+            self._rect.texture = None
+            self._rect.pos, self._rect.size = self.pos, self.size
+            return
+        w, h = self.size
+        if not self.fill:
+            # Fit inside the widget
+            tw, th = texture.size
+            if self.orientation in (6, 8):
+                tw, th = th, tw
+            scale = min(w / float(tw), h / float(th))
+            w, h = tw * scale, th * scale
+        self._rect.texture = texture
+        self._rect.tex_coords = tex_coords(texture, self.orientation, w, h,
+                                           self.fill)
+        self._rect.pos = (self.center_x - w / 2., self.center_y - h / 2.)
+        self._rect.size = (w, h)
+
+    def show_cached(self):
+        key = self.cache_key()
+        texture = atlas.get(key)
+        if texture is None:
+            return super(Thumbnail, self).show_cached()
+        self.atlas_key = key
+        self.show_texture(texture)
+        return True
+
+    def show_placeholder(self):
+        if not self.preview:
+            return
+        key = (self.source, 'preview')
+        texture = texcache.get(key)
+        if texture is None:
+            texture = load_preview(self.preview)
+            if texture is None:
+                return
+            texcache.add(key, texture)
+        self.texture = texture
+        self.brightness = 1
+        self.update_rect()
+
+    def show_data(self, fn, imdata):
+        self.release_texture()
+        key = self.cache_key()
+        texture = atlas.add(key, imdata)
+        if texture is None:
+            # Too big for a slot or the atlas is full
+            texture = Texture.create_from_data(imdata)
+            texcache.add(key, texture)
+        else:
+            self.atlas_key = key
+        self.show_texture(texture)
+
+    def show_texture(self, texture):
+        self.texture = texture
+        self.update_rect()
+        perf.thumb_shown()
+        Animation(brightness=1, duration=0.2).start(self)
+
+    def release_texture(self):
+        if self.atlas_key:
+            atlas.release(self.atlas_key)
+            self.atlas_key = None
+        self.texture = None
+
+    def hide_file(self):
+        Animation.cancel_all(self)
+        self.brightness = 0
+        self.release_texture()
+        self.update_rect()
@@ -0,0 +1,125 @@
+from json import loads, dumps
+from urllib import urlencode
+
+
+class ListingParser(object):
+    '''Incremental parser of the newline delimited json directory listings
+
+    The first line is a dict with the server dir and the listing version, the
+    rest are [name, orientation, type] direntries, optionally followed by a
+    preview of the image, a base64 encoded jpeg of a few hundred bytes
+    shown until the thumbnail is loaded. Data can be fed as it
+    arrives, in chunks which don't need to end at line boundaries. Each
+    parser keeps its own state, so several listings can be parsed at the
+    same time.
+
+    A delta listing has the version it applies to as 'base' in its first
+    line, the added or changed direntries and {"removed": [names]} lines.
+    '''
+
+    def __init__(self):
+        self.sdir = None  # Server dir
+        self.version = None
+        self.base = None  # Version a delta applies to
+        self.removed = []
+        self.direntries = []
+        self._seen = set()
+        self._tail = ""
+
+    def feed(self, data):
+        '''Parse the complete lines in data, return the new direntries'''
+        lines = (self._tail + data).split("\n")
+        self._tail = lines.pop()
+        return self._parse(lines)
+
+    def close(self):
+        '''Parse whatever is left after the last newline'''
+        lines, self._tail = [self._tail], ""
+        return self._parse(lines)
+
+    def _parse(self, lines):
+        new = []
+        for l in lines:
+            try:
+                d = loads(l)
+            except ValueError:
+                continue
+            if isinstance(d, dict):
+                self.sdir = d.get('dir', self.sdir)
+                self.version = d.get('version', self.version)
+                self.base = d.get('base', self.base)
+                self.removed.extend(d.get('removed', []))
+                continue
+            elif not isinstance(d, list):
+                continue
+            key = tuple(d)
+            if key in self._seen:
+                continue
+            self._seen.add(key)
+            new.append(d)
+        self.direntries.extend(new)
+        return new
+
+
+def get_direntries(res):
+    parser = ListingParser()
+    parser.feed(res)
+    parser.close()
+    return parser.sdir, parser.direntries
+
+
+def dump_listing(sdir, version, direntries):
+    header = {'dir': sdir}
+    if version:
+        header['version'] = version
+    return "\n".join([dumps(header)] + [dumps(de) for de in direntries]) + "\n"
+
+
+def listing_version(res):
+    try:
+        return loads(res[:res.index("\n")]).get('version')
+    except (ValueError, AttributeError):
+        return None
+
+
+def conditional_request(url, cached):
+    '''Return the url and headers to request only the changes since the
+    cached listing'''
+    version = cached and listing_version(cached)
+    if not version:
+        return url, {}
+    return (url + "?" + urlencode({'since': version}),
+            {'If-None-Match': '"%s"' % version})
+
+
+def merge_delta(cached, parser):
+    '''Apply the delta parsed by parser to the cached listing'''
+    sdir, direntries = get_direntries(cached)
+    removed = set(parser.removed)
+    changed = dict((de[0], de) for de in parser.direntries)
+    merged = []
+    for de in direntries:
+        if de[0] in removed:
+            continue
+        merged.append(changed.pop(de[0], de))
+    merged.extend(de for de in parser.direntries if de[0] in changed)
+    return parser.sdir or sdir, merged
+
+
+def update_listing(cached, req, res):
+    '''Return the (res, sdir, direntries) listing resulting from the
+    response to a conditional_request, or None if nothing changed'''
+    parser = req.parser
+    if req.resp_status == 304:
+        return None
+    if parser.base is not None:
+        if not cached or listing_version(cached) != parser.base:
+            raise ValueError("Delta for version %s, cached version is %s" % (
+                parser.base, cached and listing_version(cached)))
+        sdir, direntries = merge_delta(cached, parser)
+        res = dump_listing(sdir, parser.version, direntries)
+    else:
+        sdir, direntries = parser.sdir, parser.direntries
+    if res == cached:
+        return None
+    return res, sdir, direntries
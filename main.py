@@ -1,26 +1,49 @@
 # -*- coding: utf-8 -*-
+import startup  # First, to time the imports
 from datetime import datetime
+from os import environ
+from os.path import join
 
 from kivy import platform
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.config import Config
 from kivy.logger import Logger
-from kivy.loader import Loader
-from kivy.properties import BooleanProperty
 
-from image import CachedImage, clear_cache  # Used in the kv file
-from imagedir import ImageDir, ImageCarousel
+from cache import THUMB, FULL, MB
+from image import clear_cache
+from image import diskcache, set_cache_budget, set_texture_budget
+from image import get_cache_dir
+from image import cancel_downloads, resume_downloads
+from atlas import atlas
+from batch import thumb_batch
+from decode import decoder
+from download import scheduler
+from prefetch import grid_prefetcher, carousel_prefetcher, set_max_ahead
+from httppool import pool
+from perf import perf, PerfOverlay
+from texcache import texcache
+from imagedir import ImageDir, rescache
+from offline import offline_albums, dir_url
 
 if platform == 'android':
-    Logger.debug('KBGALLERY: Importando %s' % datetime.now())
     import android
     from jnius import autoclass, cast
     from android.runnable import run_on_ui_thread
-    Intent = autoclass('android.content.Intent')
-    String = autoclass('java.lang.String')
     PythonActivity = autoclass('org.renpy.android.PythonActivity')
     activity = PythonActivity.mActivity
 
+perf.add_stats('downloads', scheduler.stats)
+perf.add_stats('http', pool.stats)
+perf.add_stats('decoder', decoder.stats)
+perf.add_stats('disk cache', diskcache.stats)
+perf.add_stats('atlas', atlas.stats)
+perf.add_stats('textures', texcache.stats)
+perf.add_stats('grid prefetch', grid_prefetcher.stats)
+perf.add_stats('carousel prefetch', carousel_prefetcher.stats)
+
+startup.mark('import')
+
 if platform == 'win' or platform == 'linux':
     Config.set('graphics', 'width', 480)
     Config.set('graphics', 'height', 756)
@@ -33,10 +56,11 @@ __version__ = "0.0.1"
 
 class KBGalleryApp(App):
 
-    delay_image_loading = BooleanProperty(False)
+    imagecarousel = None
+    perf_overlay = None
 
     def build(self):
-        Logger.debug("%s: build %s " % (APP, datetime.now()))
+        startup.mark('build')
         self.use_kivy_settings = False
         return self.root
 
@@ -44,6 +68,12 @@ class KBGalleryApp(App):
         Logger.debug("%s: build_config %s " % (APP, datetime.now()))
         config.setdefaults('general', {
             'server_url': 'http://www.lazaro.es:8888/',
+            'thumb_cache_mb': 64,
+            'image_cache_mb': 256,
+            'texture_cache_mb': 0,
+            'max_downloads': 4,
+            'prefetch_ahead': 8,
+            'perf_overlay': 0,
         })
 
     def build_settings(self, settings):
@@ -51,6 +81,7 @@ class KBGalleryApp(App):
         settings.add_json_panel('KBGallery', self.config, 'settings.json')
 
     def on_pause(self):
+        diskcache.save()
         return True
 
     def on_resume(self):
@@ -74,8 +105,6 @@ class KBGalleryApp(App):
         return False
 
     def on_start(self):
-        Logger.debug("%s: on_start %s" % (APP, datetime.now()))
-
         from kivy.core.window import Window
         Window.bind(on_keyboard=self.on_keypress)
 
@@ -87,12 +116,15 @@ class KBGalleryApp(App):
             self.on_new_intent(activity.getIntent())
 
         self.server_url = self.config.get('general', 'server_url')
-
-        self.root.bind(
-            on_touch_down=lambda *a: setattr(self, 'delay_image_loading', True),
-            on_touch_up=lambda *a: setattr(self, 'delay_image_loading', False))
-
-        imagedir = ImageDir(server_url=self.server_url)
+        self.set_cache_budgets()
+        self.set_max_downloads(self.config.getint('general', 'max_downloads'))
+        set_max_ahead(self.config.getint('general', 'prefetch_ahead'))
+        self.show_perf_overlay(
+            self.config.getboolean('general', 'perf_overlay'))
+
+        # The server url, and so the listing read from the cache, is set
+        # after the first frame
+        imagedir = ImageDir()
         wp = 'with_previous'
         imagedir.bind(
             on_navigate_top=lambda *a: setattr(self.root, wp, False),
@@ -104,19 +136,104 @@ class KBGalleryApp(App):
         self.imagedir = imagedir
 
         self.root.container.add_widget(imagedir)
-        self.root.bind(on_touch_down=lambda *a: Loader.pause(),
-                       on_touch_up=lambda *a: Loader.resume())
-        Loader.max_upload_per_frame = 1  # Maximize interactivity
+        startup.mark('on_start')
+        # on_flip follows the drawing of the frame, unlike the first clock
+        # tick which comes before it
+        Window.bind(on_flip=self.on_first_frame)
+
+    def on_first_frame(self, window):
+        window.unbind(on_flip=self.on_first_frame)
+        startup.mark('first frame')
+        self.imagedir.bind(on_dir_shown=self.on_first_dir)
+        Clock.schedule_once(self.after_first_frame, 0)
+
+    def after_first_frame(self, dt):
+        # Show the first directory, from the cache, then the rest
+        self.imagedir.server_url = self.server_url
+        if startup.bench:
+            return
+        offline_albums.on_progress = self.update_sync_status
+        offline_albums.resume(self.server_url)
+
+    def on_first_dir(self, imagedir):
+        imagedir.unbind(on_dir_shown=self.on_first_dir)
+        startup.mark('directory')
+        if startup.bench:
+            startup.report()
+            self.stop()
 
     def on_stop(self):
-        pass
+        diskcache.sync()
 
     def reload_content(self):
         content = self.root.container.children[0]
         content.reload()
 
+    def set_cache_budgets(self):
+        set_cache_budget(
+            THUMB, self.config.getint('general', 'thumb_cache_mb') * MB)
+        set_cache_budget(
+            FULL, self.config.getint('general', 'image_cache_mb') * MB)
+        set_texture_budget(
+            self.config.getint('general', 'texture_cache_mb') * MB)
+
+    def set_max_downloads(self, max_downloads):
+        scheduler.set_max_workers(max_downloads)
+        # Leave a connection free for the directory listings
+        pool.set_max_per_host(max_downloads + 1)
+
+    def show_perf_overlay(self, show):
+        '''Show the performance overlay, recording while it is shown, or
+        always with KBGALLERY_TRACE set'''
+        from kivy.core.window import Window
+        overlay = self.perf_overlay
+        if show and overlay is None:
+            perf.enable()
+            self.perf_overlay = overlay = PerfOverlay(size=Window.size)
+            Window.bind(size=self.fit_perf_overlay)
+            Window.add_widget(overlay)
+        elif not show and overlay is not None:
+            Window.unbind(size=self.fit_perf_overlay)
+            Window.remove_widget(overlay)
+            self.perf_overlay = None
+            if not environ.get('KBGALLERY_TRACE'):
+                perf.enable(False)
+
+    def fit_perf_overlay(self, window, size):
+        self.perf_overlay.size = size
+
+    def export_trace(self):
+        if not perf.enabled:
+            self.toast("Turn on the performance overlay first")
+            return
+        fn = join(get_cache_dir(), "trace-%s.json" % (
+            datetime.now().strftime("%Y%m%d-%H%M%S")))
+        try:
+            perf.export(fn)
+        except IOError as e:
+            Logger.warning("%s: Unable to export the trace: %s" % (APP, e))
+            return
+        self.toast("Trace saved to %s" % fn)
+
+    def toggle_offline(self):
+        '''Mark the directory shown as available offline, or not anymore'''
+        server_url, path = self.imagedir.server_url, self.imagedir.path
+        if offline_albums.is_offline(server_url, path):
+            offline_albums.remove(dir_url(server_url, path))
+            self.toast("Not available offline anymore")
+        else:
+            offline_albums.add(server_url, path)
+            self.toast("Downloading for offline use")
+
+    def update_sync_status(self, sync):
+        self.root.sync_status = (
+            "" if sync.finished else "Offline %s" % sync.progress())
+
     def clear_image_cache(self):
         clear_cache()
+        rescache.clear()
+        # The offline albums were in the cache too
+        offline_albums.resync(self.imagedir.server_url)
         return True
 
     def load_previous(self, *args):
@@ -126,15 +243,22 @@ class KBGalleryApp(App):
             return
         if type(content) == ImageDir:
             self.imagedir.load_previous()
-        elif type(content) == ImageCarousel:
+        elif content is self.imagecarousel:
+            self.imagecarousel.cancel_request()
+            cancel_downloads(self.imagecarousel)
+            carousel_prefetcher.cancel()
             self.root.container.remove_widget(self.imagecarousel)
+            resume_downloads(self.imagedir)
             self.root.container.add_widget(self.imagedir)
             self.imagecarousel = None
         else:
             Logger.error("Unknown content type %s" % type(content))
 
     def load_carousel(self, widget, path, fn):
+        cancel_downloads(self.imagedir)
+        grid_prefetcher.cancel()
         self.root.container.remove_widget(self.imagedir)
+        from carousel import ImageCarousel  # Not needed until now
         imagecarousel = ImageCarousel(server_url=self.server_url, path=path,
                                       filename=fn)
         self.root.container.add_widget(imagecarousel)
@@ -143,12 +267,27 @@ class KBGalleryApp(App):
     def on_config_change(self, config, section, key, value):
         Logger.debug("%s: on_config_change key %s %s" % (
             APP, key, value))
+        if key in ('thumb_cache_mb', 'image_cache_mb', 'texture_cache_mb'):
+            self.set_cache_budgets()
+            return
+        if key == 'max_downloads':
+            self.set_max_downloads(int(value))
+            return
+        if key == 'prefetch_ahead':
+            set_max_ahead(int(value))
+            return
+        if key == 'perf_overlay':
+            self.show_perf_overlay(value in ('1', 1, True))
+            return
         try:
             content = self.root.container.children[0]
         except:
             return
         if key == 'server_url':
-            if type(content) == ImageCarousel:
+            scheduler.set_batch(thumb_batch)  # Try the new server batches
+            offline_albums.cancel()
+            offline_albums.resume(value)
+            if content is self.imagecarousel:
                 self.load_previous()
             content.server_url = value
 
@@ -158,6 +297,7 @@ class KBGalleryApp(App):
             Logger.debug("%s: texto %s, short %s" % (
                 APP, text.encode('ascii', 'ignore'), short))
             Toast = autoclass('android.widget.Toast')
+            String = autoclass('java.lang.String')
             Gravity = autoclass('android.view.Gravity')
             duration = Toast.LENGTH_SHORT if short else Toast.LENGTH_LONG
             t = Toast.makeText(activity, String(text), duration)
@@ -173,6 +313,8 @@ class KBGalleryApp(App):
         Logger.debug("%s: send_log %s" % (APP, datetime.now()))
 
         from subprocess import Popen
+        Intent = autoclass('android.content.Intent')
+        String = autoclass('java.lang.String')
         Uri = autoclass('android.net.Uri')
         File = autoclass('java.io.File')
         FileOutputStream = autoclass('java.io.FileOutputStream')
@@ -221,6 +363,4 @@ class KBGalleryApp(App):
         return v
 
 if __name__ == '__main__':
-    Logger.debug("%s: End imports. %s KBGalleryApp().run()" % (
-        APP, datetime.now()))
     KBGalleryApp().run()
@@ -0,0 +1,235 @@
+from os.path import join, getsize
+from json import loads, dumps
+from time import time
+from urllib import quote
+from posixpath import join as urljoin
+from collections import deque
+from kivy.clock import Clock
+from kivy.logger import Logger
+
+from cache import THUMB, FULL, MB, _replace, make_parent_dir
+from download import scheduler, AHEAD
+from httppool import HttpRequest
+from image import diskcache, get_cache_dir
+from imagedir import rescache, screen_query, DIR, FILE
+from listing import get_direntries
+
+APP = "KBOffline"
+
+default_rate = 1 * MB  # Bytes per second
+retry_delay = 5  # Seconds to wait after a failed request
+
+
+class AlbumSync(object):
+    '''Downloads a server directory tree for offline browsing
+
+    Walks the directories below path with the listing requests, keeping the
+    listings in the response cache, and downloads the thumbnails and the
+    screen sized images of the carousel, one at a time and at most rate
+    bytes per second on average. The downloaded entries are pinned in the
+    disk cache with the album url, so they are not evicted. Files already
+    in the cache are only pinned, so a sync stopped halfway resumes where it
+    was when it is started again.
+    '''
+
+    def __init__(self, server_url, path, rate=default_rate,
+                 on_progress=None, on_finish=None):
+        self.server_url = server_url
+        self.path = path
+        self.album = dir_url(server_url, path)
+        self.rate = rate
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+        self.dirs = deque([path])
+        self.files = deque()  # (kind, url)
+        self.total = self.done = self.failed = self.bytes = 0
+        self.ticket = None
+        self.cancelled = False
+        self.finished = False
+
+    def start(self):
+        Logger.info("%s: Syncing %s" % (APP, self.album))
+        self._next()
+
+    def cancel(self):
+        self.cancelled = True
+        if self.ticket:
+            scheduler.cancel(self.ticket)
+            self.ticket = None
+
+    def _next(self, *args):
+        if self.cancelled:
+            return
+        while self.files:
+            kind, url = self.files.popleft()
+            if diskcache.pin(kind, url, self.album):
+                self.done += 1
+                continue
+            fn = diskcache.path(kind, url)
+            make_parent_dir(fn)
+            start = time()
+            self.ticket = scheduler.fetch(
+                url, lambda req, res: self._downloaded(kind, fn, start, req),
+                on_failure=self._failed, file_path=fn, priority=AHEAD)
+            self._progress()
+            return
+        if self.dirs:
+            path = self.dirs.popleft()
+            HttpRequest(dir_url(self.server_url, path),
+                        on_success=lambda req, res: self._listed(path, res),
+                        on_failure=self._failed, on_error=self._failed)
+            return
+        self.finished = True
+        self._progress()
+        Logger.info("%s: Synced %s, %d files, %d failed" % (
+            APP, self.album, self.done, self.failed))
+        if self.on_finish:
+            self.on_finish(self)
+
+    def _listed(self, path, res):
+        if self.cancelled:
+            return
+        rescache.set(dir_url(self.server_url, path), res)
+        sdir, direntries = get_direntries(res)
+        qdir = quote(sdir.encode('utf-8'))
+        turl = self.server_url + urljoin('thumb', qdir)
+        jurl = self.server_url + urljoin('jpeg', qdir, '')
+        for name, orientation, file_type in [de[:3] for de in direntries]:
+            qname = quote(name.encode('utf-8'))
+            self.files.append((THUMB, urljoin(turl, qname + '.jpg')))
+            if file_type == DIR:
+                self.dirs.append(urljoin(path, name, ''))
+            elif file_type == FILE:
+                self.files.append(
+                    (FULL, jurl + qname + '.jpg?' + screen_query(orientation)))
+        self.total += len(direntries) + len(
+            [de for de in direntries if de[2] == FILE])
+        self._next()
+
+    def _downloaded(self, kind, fn, start, req):
+        self.ticket = None
+        headers = req.resp_headers or {}
+        try:
+            size = getsize(fn)
+        except OSError:
+            size = 0
+        diskcache.add(kind, req.url, size, etag=headers.get('etag'),
+                      mtime=headers.get('last-modified'), pinned=self.album)
+        self.done += 1
+        self.bytes += size
+        # Keep the average under rate
+        delay = float(size) / self.rate - (time() - start)
+        Clock.schedule_once(self._next, max(0, delay))
+
+    def _failed(self, req, res):
+        Logger.warning("%s: Unable to sync %s: %s" % (APP, req.url, res))
+        self.ticket = None
+        self.failed += 1
+        self.done += 1
+        Clock.schedule_once(self._next, retry_delay)
+
+    def _progress(self):
+        if self.on_progress:
+            self.on_progress(self)
+
+    def progress(self):
+        return "%d/%d" % (self.done, max(self.done, self.total))
+
+
+def dir_url(server_url, path):
+    return urljoin(server_url, quote(path.encode('utf-8')), '')
+
+
+class OfflineAlbums(object):
+    '''The albums marked as available offline, kept in offline.json in the
+    cache dir so that unfinished syncs resume in the next run. Their
+    listings are pinned in the response cache.'''
+
+    def __init__(self):
+        self.albums = None  # album url -> {server_url, path, synced}
+        self.syncs = {}  # album url -> running AlbumSync
+        self.on_progress = None
+
+    def filename(self):
+        return join(get_cache_dir(), "offline.json")
+
+    def load(self):
+        try:
+            with open(self.filename()) as f:
+                self.albums = loads(f.read())
+        except (IOError, ValueError):
+            self.albums = {}
+        rescache.set_pinned(self.albums)
+
+    def save(self):
+        rescache.set_pinned(self.albums)
+        diskcache.worker.put(_replace, self.filename(), dumps(self.albums))
+
+    def add(self, server_url, path):
+        if self.albums is None:
+            self.load()
+        album = dir_url(server_url, path)
+        self.albums[album] = {'server_url': server_url, 'path': path,
+                              'synced': False}
+        self.save()
+        self._start(album)
+
+    def remove(self, album):
+        if self.albums is None:
+            self.load()
+        sync = self.syncs.pop(album, None)
+        if sync:
+            sync.cancel()
+        self.albums.pop(album, None)
+        self.save()
+        diskcache.unpin(album)
+
+    def resume(self, server_url):
+        '''Start again the unfinished syncs of server_url'''
+        if self.albums is None:
+            self.load()
+        for album, a in self.albums.items():
+            if a['server_url'] == server_url and not a['synced']:
+                self._start(album)
+
+    def resync(self, server_url):
+        '''Download the albums again, after the caches were cleared. Only
+        the ones of server_url start now, the others when it changes'''
+        if self.albums is None:
+            self.load()
+        self.cancel()
+        for a in self.albums.values():
+            a['synced'] = False
+        self.save()
+        self.resume(server_url)
+
+    def cancel(self):
+        for sync in self.syncs.values():
+            sync.cancel()
+        self.syncs.clear()
+
+    def _start(self, album):
+        if album in self.syncs:
+            return
+        a = self.albums[album]
+        sync = AlbumSync(a['server_url'], a['path'],
+                         on_progress=self._progress, on_finish=self._finish)
+        self.syncs[album] = sync
+        sync.start()
+
+    def _progress(self, sync):
+        if self.on_progress:
+            self.on_progress(sync)
+
+    def _finish(self, sync):
+        self.syncs.pop(sync.album, None)
+        if sync.album in self.albums:
+            self.albums[sync.album]['synced'] = not sync.failed
+            self.save()
+
+    def is_offline(self, server_url, path):
+        if self.albums is None:
+            self.load()
+        return dir_url(server_url, path) in self.albums
+
+offline_albums = OfflineAlbums()
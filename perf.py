@@ -0,0 +1,240 @@
+'''Performance instrumentation
+
+Records frame times, dropped frames, the time to the first thumbnail of
+every directory, download and decode latencies, and periodic samples of
+the stats of the caches and queues, while enabled. They can be shown by
+PerfOverlay and exported as a Chrome trace, to open in chrome://tracing
+or Perfetto.
+'''
+from os import environ
+from time import time
+from json import dumps
+from bisect import bisect_left
+from collections import deque
+from threading import current_thread
+from kivy.clock import Clock
+from kivy.logger import Logger
+from kivy.graphics import Color, Rectangle
+from kivy.uix.label import Label
+
+APP = "KBPerf"
+
+frame_rate = 60  # Expected frames per second
+sample_interval = 0.5  # Seconds between samples of the stats
+max_events = 20000  # Trace events kept, oldest dropped first
+
+# Upper bounds of the histogram buckets, in ms
+buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram(object):
+    '''Durations in ms counted in the log scale buckets'''
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, ms):
+        self.counts[bisect_left(buckets, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        '''Upper bound of the bucket of the p percentile'''
+        if not self.count:
+            return 0
+        n = self.count * p / 100.
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= n:
+                return buckets[i] if i < len(buckets) else self.max
+        return self.max
+
+    def stats(self):
+        return {'count': self.count,
+                'mean': round(self.total / self.count, 1) if self.count else 0,
+                'p50': self.percentile(50), 'p95': self.percentile(95),
+                'max': round(self.max, 1),
+                'buckets': dict(zip([str(b) for b in buckets] + ['inf'],
+                                    self.counts))}
+
+
+class Perf(object):
+    '''Collects the measures and the trace events while enabled
+
+    Other modules report to the perf singleton, which ignores them when
+    disabled, and register the functions returning their stats with
+    add_stats(name, stats). The stats are sampled every sample_interval
+    seconds into counter events of the trace.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.t0 = time()
+        self.stats_sources = []  # (name, function returning a dict)
+        self._reset()
+
+    def _reset(self):
+        self.events = deque(maxlen=max_events)
+        self.histograms = {}  # name -> Histogram
+        self.frames = self.dropped = 0
+        self.first_thumbs = {}  # directory path -> ms to its first thumbnail
+        self.last_first_thumb = None
+        self._dir = None  # (path, start) of the directory being loaded
+        self._tids = {}  # Thread name -> trace tid
+
+    def add_stats(self, name, stats):
+        self.stats_sources.append((name, stats))
+
+    def enable(self, enabled=True):
+        if enabled == self.enabled:
+            return
+        self.enabled = enabled
+        if enabled:
+            self._reset()
+            Clock.schedule_interval(self._frame, 0)
+            Clock.schedule_interval(self._sample, sample_interval)
+        else:
+            Clock.unschedule(self._frame)
+            Clock.unschedule(self._sample)
+        Logger.info("%s: %s" % (APP, "Enabled" if enabled else "Disabled"))
+
+    def _tid(self, thread=None):
+        name = thread or current_thread().name
+        return self._tids.setdefault(name, len(self._tids) + 1)
+
+    def _event(self, event):
+        event['pid'] = 1
+        self.events.append(event)
+
+    def span(self, name, start, end, cat='app', thread=None, **args):
+        '''Record something that lasted from start to end, times from
+        time(), in the current thread or the one named thread'''
+        if not self.enabled:
+            return
+        self._event({'name': name, 'cat': cat, 'ph': 'X',
+                     'ts': int((start - self.t0) * 1e6),
+                     'dur': int((end - start) * 1e6),
+                     'tid': self._tid(thread), 'args': args})
+
+    def latency(self, name, start, end, thread=None, **args):
+        '''Record a span and its duration in the name histogram'''
+        if not self.enabled:
+            return
+        self.histograms.setdefault(name, Histogram()).add(
+            (end - start) * 1000)
+        self.span(name, start, end, cat=name, thread=thread, **args)
+
+    def _frame(self, dt):
+        self.frames += 1
+        self.histograms.setdefault('frame', Histogram()).add(dt * 1000)
+        dropped = int(round(dt * frame_rate)) - 1
+        if dropped > 0:
+            self.dropped += dropped
+            now = time()
+            self.span('long frame', now - dt, now, cat='frame',
+                      dropped=dropped)
+
+    def dir_started(self, path):
+        if self.enabled:
+            self._dir = (path, time())
+
+    def thumb_shown(self):
+        if not self.enabled or self._dir is None:
+            return
+        path, start = self._dir
+        self._dir = None
+        end = time()
+        self.first_thumbs[path] = self.last_first_thumb = round(
+            (end - start) * 1000, 1)
+        self.span('first thumbnail', start, end, cat='dir', path=path)
+
+    def sample(self):
+        '''Return the stats of the registered sources'''
+        stats = {}
+        for name, source in self.stats_sources:
+            try:
+                stats[name] = source()
+            except Exception as e:
+                stats[name] = {'error': str(e)}
+        return stats
+
+    def _sample(self, dt):
+        ts = int((time() - self.t0) * 1e6)
+        for name, stats in self.sample().items():
+            counters = dict((k, v) for k, v in stats.items()
+                            if isinstance(v, (int, long, float)))
+            self._event({'name': name, 'ph': 'C', 'ts': ts, 'tid': 0,
+                         'args': counters})
+
+    def summary(self):
+        return {'frames': self.frames, 'dropped': self.dropped,
+                'first_thumbnail_ms': self.first_thumbs,
+                'histograms': dict((name, h.stats()) for name, h
+                                   in self.histograms.items()),
+                'stats': self.sample()}
+
+    def export(self, filename):
+        '''Write the trace, in the Chrome trace event format, with the
+        summary as its metadata'''
+        events = list(self.events)
+        events.extend({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                       'args': {'name': name}}
+                      for name, tid in self._tids.items())
+        with open(filename, 'w') as f:
+            f.write(dumps({'traceEvents': events,
+                           'displayTimeUnit': 'ms',
+                           'metadata': self.summary()}))
+        Logger.info("%s: Exported %d events to %s" % (
+            APP, len(events), filename))
+
+
+perf = Perf()
+if environ.get('KBGALLERY_TRACE'):
+    perf.enable()
+
+
+class PerfOverlay(Label):
+    '''Text overlay with the main measures, updated while shown'''
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('font_size', '11sp')
+        kwargs.setdefault('halign', 'left')
+        kwargs.setdefault('valign', 'top')
+        super(PerfOverlay, self).__init__(**kwargs)
+        self.bind(size=lambda *a: setattr(self, 'text_size', self.size))
+        with self.canvas.before:
+            Color(0, 0, 0, 0.6)
+            self._bg = Rectangle()
+        self.bind(pos=self._update_bg, texture_size=self._update_bg)
+
+    def _update_bg(self, *args):
+        tw, th = self.texture_size
+        self._bg.pos = (self.x, self.top - th)
+        self._bg.size = (tw, th)
+
+    def on_parent(self, widget, parent):
+        Clock.unschedule(self.update)
+        if parent:
+            Clock.schedule_interval(self.update, sample_interval)
+
+    def update(self, *args):
+        h = perf.histograms
+        lines = ["frames %d  dropped %d" % (perf.frames, perf.dropped)]
+        for name in ('frame', 'download', 'decode'):
+            if name in h:
+                lines.append("%s p50 %s p95 %s ms (%d)" % (
+                    name, h[name].percentile(50), h[name].percentile(95),
+                    h[name].count))
+        if perf.last_first_thumb is not None:
+            lines.append("first thumbnail %s ms" % perf.last_first_thumb)
+        for name, stats in sorted(perf.sample().items()):
+            lines.append("%s %s" % (name, " ".join(
+                "%s=%s" % (k, round(v, 2) if isinstance(v, float) else v)
+                for k, v in sorted(stats.items())
+                if isinstance(v, (int, long, float)))))
+        self.text = "\n".join(lines)
@@ -0,0 +1,142 @@
+from os.path import getsize
+from time import time
+from math import ceil
+from functools import partial
+from kivy.logger import Logger
+
+from cache import THUMB, FULL, make_parent_dir
+from download import scheduler, AHEAD
+from image import diskcache
+
+APP = "KBPrefetch"
+
+default_max_ahead = 8
+retry_delay = 60  # Seconds before prefetching a url that failed again
+budget_share = 0.25  # Part of the cache budget prefetched images can use
+smoothing = 0.3  # Weight of the last measure in the moving averages
+
+
+class Prefetcher(object):
+    '''Warms the disk cache with the images the user is likely to see next
+
+    Callers report their position with move(position) and the urls in the
+    direction of the move, nearest first, with want(urls), in groups of
+    group urls like the images of a grid row. Only the first ahead() groups
+    are downloaded, with the AHEAD priority, and the downloads of urls not
+    wanted anymore are cancelled. The number of groups fetched ahead grows
+    when downloads take longer than the time between moves, and is bounded
+    by max_ahead and by a share of the cache budget. Urls that failed are
+    not prefetched again for retry_delay seconds.
+    '''
+
+    def __init__(self, kind, max_ahead=default_max_ahead):
+        self.kind = kind
+        self.max_ahead = max_ahead
+        self.tickets = {}  # url -> Ticket
+        self.failures = {}  # url -> time it failed
+        self.position = None
+        self.direction = 1
+        self.last_move = None
+        self.interval = None  # Average seconds between moves
+        self.duration = None  # Average seconds to download an image
+        self.size = None  # Average image size
+        self.fetched = 0
+        self.group = 1
+
+    def set_max_ahead(self, max_ahead):
+        self.max_ahead = max(0, max_ahead)
+
+    def move(self, position):
+        '''Record a move to position, return the direction, 1 or -1'''
+        now = time()
+        if self.position is not None and position != self.position:
+            self.direction = 1 if position > self.position else -1
+            if self.last_move is not None:
+                self.interval = average(self.interval, now - self.last_move)
+            self.last_move = now
+        self.position = position
+        return self.direction
+
+    def ahead(self):
+        '''Number of url groups to fetch ahead'''
+        if not self.max_ahead:
+            return 0
+        n = 1
+        if self.duration and self.interval:
+            # Enough to keep up with moves faster than the downloads
+            n = int(ceil(self.duration / self.interval)) + 1
+        if self.size:
+            budget = diskcache.budgets[self.kind] * budget_share
+            n = min(n, int(budget // (self.size * self.group)))
+        return max(0, min(n, self.max_ahead))
+
+    def want(self, urls, group=1):
+        self.group = group
+        urls = [u for u in urls[:self.ahead() * group]
+                if not self._failed(u) and not diskcache.get(self.kind, u)]
+        wanted = set(urls)
+        for url, ticket in self.tickets.items():
+            if url not in wanted:
+                scheduler.cancel(ticket)
+                del self.tickets[url]
+        for url in urls:
+            if url in self.tickets:
+                continue
+            fn = diskcache.path(self.kind, url)
+            make_parent_dir(fn)
+            self.tickets[url] = scheduler.fetch(
+                url, partial(self.fetched_url, fn, time()),
+                on_failure=self.failed, file_path=fn, priority=AHEAD)
+
+    def fetched_url(self, fn, start, req, res):
+        self.tickets.pop(req.url, None)
+        headers = req.resp_headers or {}
+        try:
+            size = getsize(fn)
+        except OSError:
+            return
+        diskcache.add(self.kind, req.url, size, etag=headers.get('etag'),
+                      mtime=headers.get('last-modified'))
+        self.duration = average(self.duration, time() - start)
+        self.size = average(self.size, size)
+        self.fetched += 1
+        Logger.debug("%s: Prefetched %s" % (APP, req.url))
+
+    def failed(self, req, res):
+        self.tickets.pop(req.url, None)
+        self.failures[req.url] = time()
+
+    def _failed(self, url):
+        '''True if url failed less than retry_delay seconds ago'''
+        t = self.failures.get(url)
+        if t is None:
+            return False
+        if time() - t < retry_delay:
+            return True
+        del self.failures[url]
+        return False
+
+    def cancel(self):
+        for ticket in self.tickets.values():
+            scheduler.cancel(ticket)
+        self.tickets.clear()
+        self.position = self.last_move = None
+
+    def stats(self):
+        return {'ahead': self.ahead(), 'pending': len(self.tickets),
+                'fetched': self.fetched, 'failed': len(self.failures)}
+
+
+def average(avg, value):
+    if avg is None:
+        return value
+    return avg + smoothing * (value - avg)
+
+
+grid_prefetcher = Prefetcher(THUMB)
+carousel_prefetcher = Prefetcher(FULL)
+
+
+def set_max_ahead(max_ahead):
+    grid_prefetcher.set_max_ahead(max_ahead)
+    carousel_prefetcher.set_max_ahead(max_ahead)
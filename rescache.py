@@ -0,0 +1,254 @@
+import errno
+from os import makedirs, rename, unlink
+from os.path import join, getsize
+from json import loads
+from threading import Lock
+from collections import OrderedDict
+from kivy.logger import Logger
+
+from cache import FileWorker, MB, make_parent_dir
+
+APP = "KBResCache"
+
+default_max_size = 8 * MB
+
+# Number of values kept in memory, besides the ones waiting to be written
+memory_items = 16
+
+
+class ResCache(object):
+    '''Cache of server responses (directory listings) by url
+
+    Values are stored in an append only log of records, each one a
+    "<key length> <value length>" header line followed by the key and the
+    value, or with a value length of -1 for deleted keys. On first use only
+    the headers are read to index the offsets of the values, which are then
+    read on demand. Every set appends a single record from the worker
+    thread, which also drops the least recently used keys when the values
+    exceed max_size and compacts the log when it is mostly garbage. Keys
+    starting with one of the pinned url prefixes are never dropped, and
+    don't count in max_size.
+    '''
+
+    def __init__(self, root=".kbimgcache", max_size=default_max_size):
+        self.filename = join(root, "rescache.log")
+        self.max_size = max_size
+        self.lock = Lock()
+        self.index = OrderedDict()  # key -> (offset, length), LRU first
+        self.size = 0  # Bytes of the live values
+        self.end = 0  # Bytes in the log
+        self.pending = {}  # key -> value set but not written yet
+        self.values = OrderedDict()  # In memory values, LRU first
+        self.worker = FileWorker()
+        self.root = root
+        self.loaded = False
+        self.pinned = ()  # Url prefixes of the keys never dropped
+
+    def load(self):
+        '''Index the log, done by the first get or set rather than at
+        startup'''
+        self.loaded = True
+        root = self.root
+        try:
+            makedirs(root)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+        try:
+            self._load()
+            found = True
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                Logger.warning("%s: Unable to read %s: %s" % (
+                    APP, self.filename, e))
+            found = False
+        try:
+            self.log = open(self.filename, "ab")
+            self.reader = open(self.filename, "rb")
+        except IOError:
+            Logger.warning(
+                "Error trying to open ResCache file %s for writing"
+                % self.filename)
+            self.log = self.reader = None
+        if not found:
+            self._import_json(join(root, "rescache.json"))
+
+    def _load(self):
+        total = getsize(self.filename)
+        with open(self.filename, "rb") as f:
+            offset = 0
+            while True:
+                header = f.readline()
+                try:
+                    klen, vlen = [int(n) for n in header.split()]
+                except ValueError:
+                    break
+                key = f.read(klen)
+                if (len(key) < klen or
+                        offset + len(header) + klen + max(vlen, 0) > total):
+                    break  # Truncated by a crash while writing
+                offset += len(header) + klen
+                if vlen < 0:
+                    self._drop(key)
+                    continue
+                f.seek(vlen, 1)
+                self._drop(key)
+                self.index[key] = (offset, vlen)
+                self.size += vlen
+                offset += vlen
+            self.end = offset
+        if self.end < total:
+            Logger.warning("%s: Discarding a truncated record" % APP)
+            with open(self.filename, "r+b") as f:
+                f.truncate(self.end)
+        Logger.info("%s: Indexed %d responses, %d bytes in a %d bytes log" % (
+            APP, len(self.index), self.size, self.end))
+
+    def _import_json(self, filename):
+        # Responses stored by the previous, single json file, implementation
+        try:
+            with open(filename) as f:
+                o = loads(f.read())
+        except (IOError, ValueError):
+            return
+        for url, res in o.items():
+            self.set(url, res.encode('utf-8'))
+        self.worker.put(unlink, filename)
+
+    def _key(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return url
+
+    def _drop(self, key):
+        old = self.index.pop(key, None)
+        if old:
+            self.size -= old[1]
+
+    def set_pinned(self, prefixes):
+        '''Keep the responses of the urls starting with one of prefixes'''
+        self.pinned = tuple(self._key(p) for p in prefixes)
+
+    def clear(self):
+        '''Forget every response, once the cache dir has been removed'''
+        self.values.clear()
+        if self.loaded:
+            self.worker.put(self._clear)
+
+    def set(self, url, res):
+        Logger.debug("Setting res for url %s" % url)
+        if not self.loaded:
+            self.load()
+        key = self._key(url)
+        with self.lock:
+            self.pending[key] = res
+        self.values.pop(key, None)
+        self.worker.put(self._write, key, res)
+
+    def get(self, url):
+        if not self.loaded:
+            self.load()
+        key = self._key(url)
+        with self.lock:
+            res = self.pending.get(key)
+            if res is None and key in self.index:
+                res = self.values.pop(key, None)
+            if res is None:
+                try:
+                    offset, length = self.index[key]
+                except KeyError:
+                    Logger.warning("Res not found for url %s" % url)
+                    return None
+                if self.reader is None:
+                    return None  # The log couldn't be opened
+                self.reader.seek(offset)
+                res = self.reader.read(length)
+            if key in self.index:
+                self.index[key] = self.index.pop(key)  # Most recently used
+        if key not in self.pending:
+            self.values[key] = res
+            if len(self.values) > memory_items:
+                self.values.popitem(last=False)
+        return res
+
+    # The methods below run in the worker thread
+
+    def _write(self, key, value):
+        if self.log is None:
+            return
+        self._append(key, value)
+        with self.lock:
+            if self.pending.get(key) is value:
+                del self.pending[key]
+            # Least recently used first
+            evicted = []
+            pinned = self.pinned
+            size = self.size
+            if pinned:
+                size -= sum(length for k, (offset, length)
+                            in self.index.iteritems() if k.startswith(pinned))
+            for k, (offset, length) in self.index.iteritems():
+                if size <= self.max_size:
+                    break
+                if pinned and k.startswith(pinned):
+                    continue
+                evicted.append(k)
+                size -= length
+        for k in evicted:
+            Logger.debug("%s: Evicting %s" % (APP, k))
+            self._append(k, None)
+        if self.end > 2 * self.size + MB:
+            self._compact()
+
+    def _append(self, key, value):
+        header = "%d %d\n" % (len(key), -1 if value is None else len(value))
+        self.log.write(header + key + (value or ""))
+        self.log.flush()
+        with self.lock:
+            offset = self.end + len(header) + len(key)
+            self.end = offset + len(value or "")
+            self._drop(key)
+            if value is not None:
+                self.index[key] = (offset, len(value))
+                self.size += len(value)
+
+    def _clear(self):
+        with self.lock:
+            for f in (self.log, self.reader):
+                if f is not None:
+                    f.close()
+            self.index.clear()
+            self.size = self.end = 0
+            try:
+                make_parent_dir(self.filename)
+                self.log = open(self.filename, "ab")
+                self.reader = open(self.filename, "rb")
+            except (IOError, OSError):
+                Logger.warning("%s: Unable to open %s again" % (
+                    APP, self.filename))
+                self.log = self.reader = None
+
+    def _compact(self):
+        with self.lock:
+            live = self.index.items()
+        tmp = self.filename + ".tmp"
+        index = OrderedDict()
+        with open(self.filename, "rb") as src:
+            with open(tmp, "wb") as dst:
+                for key, (offset, length) in live:
+                    src.seek(offset)
+                    header = "%d %d\n" % (len(key), length)
+                    dst.write(header + key)
+                    index[key] = (dst.tell(), length)
+                    dst.write(src.read(length))
+                end = dst.tell()
+        with self.lock:
+            rename(tmp, self.filename)
+            self.log.close()
+            self.reader.close()
+            self.log = open(self.filename, "ab")
+            self.reader = open(self.filename, "rb")
+            self.index = index
+            self.end = end
+            self.size = sum(length for offset, length in index.values())
+        Logger.info("%s: Compacted log to %d bytes" % (APP, end))
@@ -0,0 +1,33 @@
+'''Startup timings
+
+main imports this module first, and marks the end of each startup phase
+with mark(phase). With KBGALLERY_BENCH_STARTUP set in the environment the
+app prints the timings and exits once it shows the top level directory,
+which is what bench_startup.py runs.
+'''
+from time import time
+t0 = time()
+
+from os import environ
+from json import dumps
+from kivy.logger import Logger
+
+APP = "KBStartup"
+
+bench = bool(environ.get('KBGALLERY_BENCH_STARTUP'))
+marks = []  # (phase, seconds since t0)
+
+
+def mark(phase):
+    t = time() - t0
+    marks.append((phase, t))
+    Logger.debug("%s: %s at %.1f ms" % (APP, phase, t * 1000))
+
+
+def report():
+    '''Print the duration of each phase, as a json line'''
+    phases, last = [], 0
+    for phase, t in marks:
+        phases.append([phase, round((t - last) * 1000, 1)])
+        last = t
+    print "KBSTARTUP " + dumps(phases)
@@ -0,0 +1,17 @@
+'''Tests of the app modules against fakeserver.FakeServer
+
+Run them from the app directory with: python -m unittest discover
+'''
+from time import time, sleep
+from kivy.clock import Clock
+
+timeout = 10  # Seconds to wait for the responses of the server
+
+
+def wait_for(condition):
+    '''Run the clock until condition() is true or timeout, return it'''
+    deadline = time() + timeout
+    while not condition() and time() < deadline:
+        Clock.tick()
+        sleep(0.01)
+    return condition()
@@ -0,0 +1,176 @@
+import unittest
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from batch import PackParser, pack_item, thumb_batch
+from download import Scheduler
+from fakeserver import Gallery, FakeServer, Handler
+from tests import wait_for
+
+N = 10
+
+
+def thumb(i):
+    '''Data of the thumbnail i, big enough to be read in several chunks'''
+    return ("%06d" % i) * 2000
+
+
+class PackParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.files = dict((name, join(self.dir, name))
+                          for name in ('a', 'b', 'c', 'd'))
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def read(self, name):
+        with open(self.files[name], 'rb') as f:
+            return f.read()
+
+    def test_split_items(self):
+        body = (pack_item('a', "first\nitem") + pack_item('b', None) +
+                pack_item('c', ""))
+        parser = PackParser(self.files)
+        items = []
+        for i in range(len(body)):
+            items.extend(parser.feed(body[i]))
+        items.extend(parser.close())
+        self.assertEqual(items, [('a', True), ('b', False), ('c', True),
+                                 ('d', False)])
+        self.assertEqual(self.read('a'), "first\nitem")
+        self.assertEqual(self.read('c'), "")
+
+    def test_unknown_and_repeated_names(self):
+        body = (pack_item('x', "?") + pack_item('a', "1") +
+                pack_item('a', "2"))
+        parser = PackParser(self.files)
+        self.assertEqual(parser.feed(body), [('a', True)])
+        self.assertEqual(self.read('a'), "1")
+
+
+class BatchHandler(Handler):
+    '''Answers the batch requests with the status of the server, or
+    leaves the last name out of them'''
+
+    def do_GET(self):
+        if self.path.startswith('/thumbs/'):
+            status = self.server.batch_status
+            if status != 200:
+                self.server.count(self.path[1:self.path.index('?')])
+                return self.send(status, "No batches")
+            if self.server.drop_last:
+                self.path = self.path[:self.path.rindex('&')]
+        Handler.do_GET(self)
+
+
+class SchedulerBatchTest(unittest.TestCase):
+    '''Thumbnail downloads batched by the Scheduler'''
+
+    def setUp(self):
+        self.gallery = Gallery()
+        self.gallery.put_dir('d', [])
+        for i in range(N):
+            self.gallery.put_image('d/img%d.jpg' % i, thumb(i))
+        self.server = FakeServer(self.gallery).start()
+        self.server.RequestHandlerClass = BatchHandler
+        self.server.batch_status = 200
+        self.server.drop_last = False
+        self.dir = mkdtemp()
+        self.scheduler = Scheduler(batch=thumb_batch)
+        self.ok, self.failed = [], []
+
+    def tearDown(self):
+        self.server.stop()
+        rmtree(self.dir)
+
+    def url(self, i):
+        return self.server.url + 'thumb/d/img%d.jpg.jpg' % i
+
+    def fetch_all(self):
+        '''Ask for the N thumbnails in the same frame, wait for them'''
+        for i in range(N):
+            self.scheduler.fetch(
+                self.url(i),
+                lambda req, res, i=i: self.ok.append(i),
+                lambda req, res, i=i: self.failed.append(i),
+                file_path=join(self.dir, str(i)))
+        self.assertTrue(wait_for(
+            lambda: len(self.ok) + len(self.failed) == N))
+        self.assertFalse(self.scheduler.pending)
+
+    def requests(self, kind):
+        return sum(n for path, n in self.server.requests.items()
+                   if path.startswith(kind + '/'))
+
+    def assert_downloaded(self, indices):
+        self.assertEqual(sorted(self.ok), sorted(indices))
+        for i in indices:
+            with open(join(self.dir, str(i)), 'rb') as f:
+                self.assertEqual(f.read(), thumb(i))
+
+    def test_batched(self):
+        self.fetch_all()
+        self.assert_downloaded(range(N))
+        self.assertEqual(self.requests('thumbs'), 1)
+        self.assertEqual(self.requests('thumb'), 0)
+
+    def test_batch_size(self):
+        self.scheduler.set_batch(thumb_batch, batch_size=4)
+        self.fetch_all()
+        self.assert_downloaded(range(N))
+        self.assertEqual(self.requests('thumbs'), 3)
+
+    def test_missing_items(self):
+        self.gallery.put_image('d/img3.jpg', None)
+        self.gallery.put_image('d/img7.jpg', None)
+        self.fetch_all()
+        self.assert_downloaded(set(range(N)) - set([3, 7]))
+        self.assertEqual(sorted(self.failed), [3, 7])
+        self.assertEqual(self.requests('thumb'), 0)
+
+    def test_names_left_out(self):
+        self.server.drop_last = True
+        self.fetch_all()
+        self.assertEqual(len(self.failed), 1)
+        self.assert_downloaded(set(range(N)) - set(self.failed))
+
+    def test_unsupported(self):
+        for status in (404, 405, 501):
+            self.server.batch_status = status
+            self.server.requests.clear()
+            self.scheduler.set_batch(thumb_batch)
+            self.ok, self.failed = [], []
+            self.fetch_all()
+            # Done one by one, without trying batches again
+            self.assert_downloaded(range(N))
+            self.assertIsNone(self.scheduler.batch)
+            self.assertEqual(self.requests('thumbs'), 1)
+            self.assertEqual(self.requests('thumb'), N)
+
+    def test_failed_batch_queued_again(self):
+        self.server.batch_status = 500
+        self.fetch_all()
+        self.assert_downloaded(range(N))
+        self.assertEqual(self.requests('thumbs'), 1)
+        self.assertEqual(self.requests('thumb'), N)
+        # The server may support batches still
+        self.assertIsNotNone(self.scheduler.batch)
+        self.server.batch_status = 200
+        self.server.requests.clear()
+        self.ok = []
+        for i in range(N):
+            self.gallery.put_image('d/new%d.jpg' % i, thumb(i))
+        for i in range(N):
+            self.scheduler.fetch(
+                self.server.url + 'thumb/d/new%d.jpg.jpg' % i,
+                lambda req, res, i=i: self.ok.append(i),
+                file_path=join(self.dir, str(i)))
+        self.assertTrue(wait_for(lambda: len(self.ok) == N))
+        self.assertEqual(self.requests('thumbs'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
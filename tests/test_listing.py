@@ -0,0 +1,128 @@
+import unittest
+
+from fakeserver import Gallery, FakeServer, FILE, DIR, listing_version
+from httppool import HttpRequest
+from listing import ListingParser, conditional_request, update_listing
+from listing import get_direntries
+from tests import wait_for
+
+DIRENTRIES = [["a.jpg", 1, FILE], ["b.jpg", 6, FILE], ["c.jpg", 1, FILE],
+              ["sub", 1, DIR]]
+
+
+class ListingSyncTest(unittest.TestCase):
+    '''Conditional listing requests, as ImageDir and the carousel do them'''
+
+    gallery_class = Gallery
+
+    def setUp(self):
+        self.gallery = self.gallery_class()
+        self.gallery.put_dir('d', DIRENTRIES)
+        self.server = FakeServer(self.gallery).start()
+        self.url = self.server.url + 'd/'
+
+    def tearDown(self):
+        self.server.stop()
+
+    def fetch(self, cached=None):
+        '''Request the listing, only its changes since cached if given,
+        return the finished request and its result'''
+        req_url, headers = conditional_request(self.url, cached)
+        done = []
+        req = HttpRequest(req_url, req_headers=headers,
+                          parser=ListingParser(),
+                          on_success=lambda req, res: done.append(res),
+                          on_failure=lambda req, res: done.append(res),
+                          on_error=lambda req, e: done.append(e))
+        self.assertTrue(wait_for(lambda: done))
+        return req, done[0]
+
+    def sync(self, cached=None):
+        req, res = self.fetch(cached)
+        return req, update_listing(cached, req, res)
+
+    def full_listing(self):
+        req, (res, sdir, direntries) = self.sync()
+        self.assertEqual(req.resp_status, 200)
+        return res
+
+    def test_full_listing(self):
+        res = self.full_listing()
+        sdir, direntries = get_direntries(res)
+        self.assertEqual(sdir, 'd')
+        self.assertEqual(direntries, DIRENTRIES)
+
+    def test_not_modified(self):
+        cached = self.full_listing()
+        req, update = self.sync(cached)
+        self.assertEqual(req.resp_status, 304)
+        self.assertIsNone(update)
+
+    def test_delta(self):
+        cached = self.full_listing()
+        new = [["a.jpg", 1, FILE], ["b.jpg", 8, FILE], ["sub", 1, DIR],
+               ["d.jpg", 3, FILE]]
+        self.gallery.put_dir('d', new)
+        req, (res, sdir, direntries) = self.sync(cached)
+        self.assertEqual(req.resp_status, 200)
+        # Only the changes were sent
+        self.assertEqual(req.parser.base, listing_version(DIRENTRIES))
+        self.assertEqual(req.parser.direntries,
+                         [["b.jpg", 8, FILE], ["d.jpg", 3, FILE]])
+        self.assertEqual(req.parser.removed, ["c.jpg"])
+        self.assertEqual(sorted(direntries), sorted(new))
+        self.assertEqual(get_direntries(res), (sdir, direntries))
+        # The merged listing has the version of the server's
+        req, update = self.sync(res)
+        self.assertEqual(req.resp_status, 304)
+        self.assertIsNone(update)
+
+    def test_base_mismatch(self):
+        old = self.full_listing()
+        self.gallery.put_dir('d', DIRENTRIES[:2])
+        cached = self.full_listing()
+        self.gallery.put_dir('d', DIRENTRIES[:1])
+        # A delta since old, while the cache was replaced meanwhile
+        req, res = self.fetch(old)
+        self.assertEqual(req.parser.base, listing_version(DIRENTRIES))
+        self.assertRaises(ValueError, update_listing, cached, req, res)
+        # Which the full listing recovers from
+        req, (res, sdir, direntries) = self.sync()
+        self.assertEqual(direntries, DIRENTRIES[:1])
+
+
+class FullListingGallery(Gallery):
+    '''A server without deltas'''
+
+    def listing(self, path, since=None):
+        return Gallery.listing(self, path)
+
+
+class IgnoredSinceTest(ListingSyncTest):
+    '''The same requests to a server which ignores since'''
+
+    gallery_class = FullListingGallery
+
+    def test_delta(self):
+        cached = self.full_listing()
+        new = [["a.jpg", 1, FILE], ["d.jpg", 3, FILE]]
+        self.gallery.put_dir('d', new)
+        req, (res, sdir, direntries) = self.sync(cached)
+        self.assertEqual(req.resp_status, 200)
+        self.assertIsNone(req.parser.base)
+        self.assertEqual(direntries, new)
+        self.assertEqual(get_direntries(res), ('d', new))
+
+    def test_base_mismatch(self):
+        # Full listings always apply
+        old = self.full_listing()
+        self.gallery.put_dir('d', DIRENTRIES[:2])
+        cached = self.full_listing()
+        self.gallery.put_dir('d', DIRENTRIES[:1])
+        req, res = self.fetch(old)
+        res, sdir, direntries = update_listing(cached, req, res)
+        self.assertEqual(direntries, DIRENTRIES[:1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+from io import BytesIO
+from urllib2 import urlopen
+from urlparse import parse_qs
+
+import imagedir
+from fakeserver import Gallery, FakeServer, PILImage, sample_jpeg
+from imagedir import screen_query, screen_step
+
+
+class FakeWindow(object):
+    size = (1000, 600)
+
+
+def query_size(query):
+    q = parse_qs(query)
+    return int(q['w'][0]), int(q['h'][0])
+
+
+class ScreenQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.window = imagedir.Window
+        imagedir.Window = FakeWindow()
+
+    def tearDown(self):
+        imagedir.Window = self.window
+
+    def test_rounded_up(self):
+        self.assertEqual(query_size(screen_query(1)), (1024, 768))
+        imagedir.Window.size = (screen_step * 4 + 1, 1)
+        self.assertEqual(query_size(screen_query(1)),
+                         (screen_step * 5, screen_step))
+
+    def test_exact_steps_kept(self):
+        imagedir.Window.size = (screen_step * 4, screen_step * 3)
+        self.assertEqual(query_size(screen_query(1)),
+                         (screen_step * 4, screen_step * 3))
+
+    def test_rotated(self):
+        # Images are stored unrotated, so 6 and 8 swap width and height
+        self.assertEqual(query_size(screen_query(3)), (1024, 768))
+        self.assertEqual(query_size(screen_query(6)), (768, 1024))
+        self.assertEqual(query_size(screen_query(8)), (768, 1024))
+
+
+@unittest.skipIf(PILImage is None, "needs PIL")
+class ResizeTest(unittest.TestCase):
+    '''The screen variants served by FakeServer'''
+
+    def setUp(self):
+        self.data = sample_jpeg((640, 480))
+        gallery = Gallery()
+        gallery.put_image('d/img.jpg', self.data)
+        self.server = FakeServer(gallery).start()
+        self.window = imagedir.Window
+        imagedir.Window = FakeWindow()
+
+    def tearDown(self):
+        imagedir.Window = self.window
+        self.server.stop()
+
+    def fetch(self, query):
+        return urlopen(self.server.url + 'jpeg/d/img.jpg.jpg?' +
+                       query).read()
+
+    def size(self, query):
+        return PILImage.open(BytesIO(self.fetch(query))).size
+
+    def test_shrunk_to_fit(self):
+        self.assertEqual(self.size('w=200&h=100'), (133, 100))
+        self.assertEqual(self.size('w=100&h=200'), (100, 75))
+
+    def test_smaller_not_enlarged(self):
+        self.assertEqual(self.fetch('w=1000&h=1000'), self.data)
+
+    def test_screen_query(self):
+        imagedir.Window.size = (300, 200)
+        w, h = self.size(screen_query(1))
+        self.assertTrue(w <= 512 and h <= 256)
+        self.assertTrue(w == 512 or h == 256)
+        w, h = self.size(screen_query(6))
+        self.assertTrue(w <= 256 and h <= 512)
+        self.assertTrue(w == 256 or h == 512)
+
+
+if __name__ == '__main__':
+    unittest.main()
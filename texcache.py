@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from kivy.logger import Logger
+
+from cache import MB
+
+APP = "KBTexCache"
+
+default_budget = 64 * MB
+
+
+class TextureCache(object):
+    '''Decoded images kept in memory, to show them again without reading
+    and decoding their file
+
+    Keys are the url and the size the image was decoded for. Textures are
+    accounted by their pixels times the bytes per pixel, and the least
+    recently used ones dropped when they exceed budget. Widgets still
+    showing a dropped texture keep it alive until they let it go.
+    '''
+
+    def __init__(self, budget=default_budget):
+        self.budget = budget
+        self.textures = OrderedDict()  # key -> (texture, bytes), LRU first
+        self.usage = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def set_budget(self, budget):
+        self.budget = max(0, budget)
+        self._evict()
+
+    def get(self, key):
+        '''Return the texture of key, or None if it is not cached'''
+        try:
+            item = self.textures.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.textures[key] = item  # Most recently used
+        self.hits += 1
+        return item[0]
+
+    def add(self, key, texture):
+        old = self.textures.pop(key, None)
+        if old:
+            self.usage -= old[1]
+        w, h = texture.size
+        size = w * h * len(texture.colorfmt)
+        if size > self.budget:
+            return
+        self.textures[key] = (texture, size)
+        self.usage += size
+        self._evict()
+
+    def _evict(self):
+        while self.usage > self.budget and self.textures:
+            key, (texture, size) = self.textures.popitem(last=False)
+            self.usage -= size
+            self.evictions += 1
+            Logger.debug("%s: Evicting %s" % (APP, key[0]))
+
+    def clear(self):
+        self.textures.clear()
+        self.usage = 0
+
+    def stats(self):
+        return {'textures': len(self.textures), 'bytes': self.usage,
+                'budget': self.budget, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+texcache = TextureCache()
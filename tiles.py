@@ -0,0 +1,242 @@
+from json import loads
+from math import ceil, floor, log, radians, cos, sin
+from os.path import getsize
+from functools import partial
+from kivy.clock import Clock
+from kivy.logger import Logger
+from kivy.graphics import Color, Rectangle
+from kivy.graphics.texture import Texture
+from kivy.uix.widget import Widget
+
+from cache import FULL, make_parent_dir
+from decode import decoder
+from download import scheduler, VISIBLE
+from httppool import HttpRequest
+
+APP = "KBTiles"
+
+
+class Tile(object):
+
+    def __init__(self, key, url):
+        self.key = key  # (level, col, row)
+        self.url = url
+        self.ticket = None
+        self.decode_job = None
+        self.rect = None  # Set once drawn
+
+
+class TileLayer(Widget):
+    '''Draws the tiles of an image pyramid over the image of a CachedImage
+
+    The server has the image at levels of detail, level 0 being the full
+    size image and every level half the size of the previous one, cut in
+    tiles of tile_size pixels:
+
+        <tiles url>info                     {"width": w, "height": h,
+                                             "tile_size": t, "levels": n}
+        <tiles url><level>/<col>_<row>.jpg  tile, col and row from the top
+                                            left corner
+
+    The layer covers the image without its rotation, and only the tiles
+    intersecting the view, at the level matching the zoom, are downloaded
+    and drawn. Tiles out of the view are dropped, while the coarser ones
+    are kept until the finer ones replace them.
+    '''
+
+    def __init__(self, url, view, scatter, cache, on_failure=None, **kwargs):
+        super(TileLayer, self).__init__(**kwargs)
+        self.url = url
+        self.view = view  # Widget the image is seen through
+        self.scatter = scatter
+        self.cache = cache  # DiskCache of the tiles
+        self.on_failure = on_failure
+        self.info = None
+        self.angle = 0
+        self.tiles = {}  # key -> Tile, wanted or drawn
+
+        self._trigger_update = Clock.create_trigger(self.update)
+        scatter.bind(transform=self._trigger_update)
+        self.bind(pos=self._trigger_update, size=self._trigger_update)
+
+        self.req = HttpRequest(url + "info", on_success=self.got_info,
+                               on_failure=self.failed, on_error=self.failed)
+
+    def got_info(self, req, res):
+        self.req = None
+        try:
+            info = loads(res)
+            self.info = (int(info['width']), int(info['height']),
+                         int(info['tile_size']), int(info['levels']))
+        except (ValueError, TypeError, KeyError) as e:
+            return self.failed(req, e)
+        self.update()
+
+    def failed(self, req, res):
+        self.req = None
+        Logger.warning("%s: No tiles at %s: %s" % (APP, self.url, res))
+        if self.on_failure:
+            self.on_failure(self)
+
+    def level(self):
+        '''Coarsest level with at least one image pixel per screen pixel'''
+        width, height, tile_size, levels = self.info
+        shown = self.scatter.scale * self.width
+        if shown <= 0:
+            return levels - 1
+        n = int(floor(log(width / shown, 2)))
+        return min(levels - 1, max(0, n))
+
+    def visible_area(self):
+        '''Return the part of the image in the view, as (x0, y0, x1, y1)
+        fractions of the image from its top left corner'''
+        view = self.view
+        a = radians(-self.angle)
+        cx, cy = self.center
+        xs, ys = [], []
+        for x, y in ((view.x, view.y), (view.right, view.y),
+                     (view.x, view.top), (view.right, view.top)):
+            x, y = self.scatter.to_widget(*view.to_window(x, y))
+            # Undo the rotation of the image
+            x, y = x - cx, y - cy
+            xs.append(cx + x * cos(a) - y * sin(a))
+            ys.append(cy + x * sin(a) + y * cos(a))
+        w, h = float(self.width), float(self.height)
+        if not w or not h:
+            return None
+        x0 = max(0., (min(xs) - self.x) / w)
+        x1 = min(1., (max(xs) - self.x) / w)
+        y0 = max(0., (self.top - max(ys)) / h)
+        y1 = min(1., (self.top - min(ys)) / h)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+    def tile_area(self, key):
+        '''Part of the image covered by the tile, as in visible_area'''
+        width, height, tile_size, levels = self.info
+        level, col, row = key
+        lw = int(ceil(width / 2. ** level))
+        lh = int(ceil(height / 2. ** level))
+        return (col * tile_size / float(lw), row * tile_size / float(lh),
+                min(lw, (col + 1) * tile_size) / float(lw),
+                min(lh, (row + 1) * tile_size) / float(lh))
+
+    def update(self, *args):
+        if self.info is None:
+            return
+        area = self.visible_area()
+        level = self.level()
+        wanted = set()
+        if area:
+            width, height, tile_size, levels = self.info
+            lw = ceil(width / 2. ** level)
+            lh = ceil(height / 2. ** level)
+            x0, y0, x1, y1 = area
+            for row in range(int(y0 * lh // tile_size),
+                             int(ceil(y1 * lh / tile_size))):
+                for col in range(int(x0 * lw // tile_size),
+                                 int(ceil(x1 * lw / tile_size))):
+                    wanted.add((level, col, row))
+
+        for key, tile in self.tiles.items():
+            if key in wanted:
+                continue
+            if (tile.rect and key[0] > level and self.intersects(key, area)
+                    and not self.covered(key, wanted)):
+                continue  # Coarser tile shown until the finer ones are
+            self.drop(tile)
+
+        for key in wanted:
+            if key not in self.tiles:
+                self.load(key)
+        self.place()
+
+    def intersects(self, key, area):
+        if area is None:
+            return False
+        x0, y0, x1, y1 = self.tile_area(key)
+        return x0 < area[2] and area[0] < x1 and y0 < area[3] and area[1] < y1
+
+    def covered(self, key, wanted):
+        '''True if the wanted tiles over the tile key are all drawn'''
+        for k in wanted:
+            tile = self.tiles.get(k)
+            if (tile is None or not tile.rect) and \
+                    self.intersects(k, self.tile_area(key)):
+                return False
+        return True
+
+    def load(self, key):
+        tile = Tile(key, "%s%d/%d_%d.jpg" % ((self.url,) + key))
+        self.tiles[key] = tile
+        fn = self.cache.lookup(FULL, tile.url)
+        if fn:
+            self.decode(tile, fn)
+        else:
+            fn = self.cache.path(FULL, tile.url)
+            make_parent_dir(fn)
+            tile.ticket = scheduler.fetch(
+                tile.url, partial(self.downloaded, tile, fn),
+                on_failure=partial(self.tile_failed, tile),
+                file_path=fn, priority=VISIBLE)
+
+    def downloaded(self, tile, fn, req, res):
+        tile.ticket = None
+        try:
+            self.cache.add(FULL, tile.url, getsize(fn))
+        except OSError:
+            return
+        if self.tiles.get(tile.key) is tile:
+            self.decode(tile, fn)
+
+    def tile_failed(self, tile, req, res):
+        tile.ticket = None
+
+    def decode(self, tile, fn):
+        tile.decode_job = decoder.decode(fn, partial(self.decoded, tile))
+
+    def decoded(self, tile, imdata):
+        tile.decode_job = None
+        if imdata is None or self.tiles.get(tile.key) is not tile:
+            return
+        texture = Texture.create_from_data(imdata)
+        tile.rect = Rectangle(texture=texture)
+        self.update()
+
+    def drop(self, tile):
+        del self.tiles[tile.key]
+        if tile.ticket:
+            scheduler.cancel(tile.ticket)
+        if tile.decode_job:
+            decoder.cancel(tile.decode_job)
+        tile.rect = None
+
+    def place(self):
+        '''Draw the tiles, coarser ones first'''
+        canvas = self.canvas
+        canvas.clear()
+        canvas.add(Color(1, 1, 1, 1))
+        w, h = self.width, self.height
+        for key in sorted(self.tiles, reverse=True):
+            tile = self.tiles[key]
+            if not tile.rect:
+                continue
+            x0, y0, x1, y1 = self.tile_area(key)
+            tile.rect.pos = (self.x + x0 * w, self.top - y1 * h)
+            tile.rect.size = ((x1 - x0) * w, (y1 - y0) * h)
+            canvas.add(tile.rect)
+
+    def clear(self):
+        if self.req:
+            self.req.cancel()  # No got_info nor failed after it
+            self.req = None
+        self.scatter.unbind(transform=self._trigger_update)
+        for tile in self.tiles.values():
+            self.drop(tile)
+        self.canvas.clear()
+        self.info = None
+
+    def stats(self):
+        return {'tiles': len(self.tiles),
+                'drawn': len([t for t in self.tiles.values() if t.rect])}